@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Offline benchmarks of the matrix-zabbix-bot. Starts a fake
+Zabbix server (fake_zabbix.py) and a fake Matrix homeserver (fake_matrix.py)
+in child processes, then times the zabbix.py functions and the !zabbix
+commands, from zabbix_bot.zabbix_callback until the reply reaches the
+homeserver.
+
+Per case it reports the wall time, the Zabbix API calls and HTTP requests,
+the bytes sent to and received from both servers and the peak memory of the
+bot process (measured in a separate run, as tracemalloc slows it down).
+The snapshot cache is disabled, so every case queries Zabbix.
+
+Example: python benchmarks/bench.py -n 10 1000 -o results.json
+         python benchmarks/bench.py -n 1000 -b results.json
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.request
+
+import yaml
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'matrix-zabbix-bot'))
+
+import zabbix  # noqa: E402
+
+ROOM = '!bench:localhost'
+USER_ID = '@bench:localhost'
+SIZES = [10, 100, 1000, 10000]
+
+# Arguments of the !zabbix commands that are run, in this order.
+COMMANDS = [
+    '',
+    'all',
+    'more',
+    'acked',
+    'unacked min=high',
+    'unacked host=host-00001',
+    'unacked group=Group* limit=20',
+    'ack 1 2 4',
+    'ack host=host-00002',
+    'graph host-00001 agent.ping 1d',
+]
+
+# Seconds to wait for the reply of a command.
+REPLY_TIMEOUT = 300
+
+# Wall times may grow by this factor before they count as a regression,
+# plus some slack for very short cases.
+TOLERANCE = 1.5
+SLACK = 0.005
+
+COLORS = {
+    'zabbix_not classified': '#97AAB3,\u2754',
+    'zabbix_information': '#7499FF,\u2139',
+    'zabbix_warning': '#FFC859,\u26a0',
+    'zabbix_average': '#FFA059,\u2757',
+    'zabbix_high': '#E97659,\u203c',
+    'zabbix_disaster': '#E45959,\U0001f525',
+}
+
+
+def _unacked_ids(size, count):
+    """Returns ids of unacknowledged problems of the fake dataset.
+    """
+    return [str(triggerid) for triggerid in range(1, size + 1)
+            if triggerid % 5 and triggerid % 3][:count]
+
+
+FUNCTIONS = [
+    ('get_triggers', lambda config, size: zabbix.get_triggers(config)),
+    ('get_unacked_triggers',
+     lambda config, size: zabbix.get_unacked_triggers(config)),
+    ('get_acked_triggers',
+     lambda config, size: zabbix.get_acked_triggers(config)),
+    ('get_triggers_by_ack',
+     lambda config, size: zabbix.get_triggers_by_ack(config)),
+    ('iter_triggers min=high',
+     lambda config, size: list(zabbix.iter_triggers(
+         config, acked=False,
+         selectors=zabbix.parse_selectors(['min=high'])))),
+    ('ack_triggers x10',
+     lambda config, size: zabbix.ack_triggers(
+         config, _unacked_ids(size, 10))),
+    ('get_itemvalue_table',
+     lambda config, size: zabbix.get_itemvalue_table(
+         config, 'Group 1', ['agent.ping', 'system.cpu.load'])),
+]
+
+
+class Fake(object):
+    """A fake server in a child process.
+    """
+    def __init__(self, script, *args):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, script)] + list(args),
+            stdout=subprocess.PIPE)
+        self.port = int(self.process.stdout.readline())
+        self.url = 'http://127.0.0.1:{0}'.format(self.port)
+
+    def stats(self):
+        with urllib.request.urlopen(self.url + '/_bench/stats') as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def reset(self):
+        request = urllib.request.Request(self.url + '/_bench/reset',
+                                         data=b'', method='POST')
+        urllib.request.urlopen(request).close()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Bot(object):
+    """Sets up the globals of zabbix_bot as main() would, against the fake
+    servers. Every reply that reaches the homeserver is signalled.
+    """
+    def __init__(self, config_path, homeserver):
+        import bot_config
+        import dispatch
+        import pager
+        import send_queue
+        import zabbix_bot
+        from matrix_client.client import MatrixClient
+
+        self.module = zabbix_bot
+        self.replies = threading.Semaphore(0)
+        zabbix_bot.settings = bot_config.ConfigHolder(config_path)
+        zabbix_bot.matrix_config = dict(zabbix_bot.settings.current.matrix)
+        zabbix_bot.bot = types.SimpleNamespace(
+            client=MatrixClient(homeserver, token='token', user_id=USER_ID))
+        zabbix_bot.pagers = pager.Pagers()
+        zabbix_bot.commands = dispatch.CommandPool(zabbix_bot._deliver)
+        zabbix_bot.outbox = send_queue.SendQueue(self._send)
+        zabbix_bot.outbox.start()
+        self.room = zabbix_bot.bot.client.join_room(ROOM)
+
+    def _send(self, room_id, message, message_type):
+        self.module._send(room_id, message, message_type)
+        self.replies.release()
+
+    def command(self, args):
+        """Runs a !zabbix command and waits for its reply.
+        """
+        body = ' '.join(['!zabbix'] + ([args] if args else []))
+        self.module.zabbix_callback(self.room, {'content': {'body': body}})
+        if not self.replies.acquire(timeout=REPLY_TIMEOUT):
+            raise RuntimeError('no reply to "{0}"'.format(body))
+
+
+def measure(run, servers, repeat, memory):
+    """Runs a case and collects its numbers. The fake servers are reset
+    before every run, so acknowledgements do not carry over.
+
+    :param run: the case
+    :type run: callable
+    :param servers: {name: Fake}
+    :type servers: dict
+    :param repeat: number of timed runs, the median is reported
+    :type repeat: int
+    :param memory: do an extra run to measure the peak memory
+    :type memory: bool
+    :return: dict of results
+    """
+    times = []
+    for _ in range(repeat):
+        for server in servers.values():
+            server.reset()
+
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    stats = {name: server.stats() for name, server in servers.items()}
+    result = {
+        'wall': statistics.median(times),
+        'zabbix_calls': stats['zabbix']['calls'],
+        'total_calls': stats['zabbix']['total_calls'],
+        'zabbix_requests': stats['zabbix']['requests'],
+        'zabbix_bytes': stats['zabbix']['bytes_in'] +
+                        stats['zabbix']['bytes_out'],
+        'matrix_requests': stats['matrix']['requests'],
+        'matrix_bytes': stats['matrix']['bytes_in'] +
+                        stats['matrix']['bytes_out'],
+        'peak': None,
+    }
+    if memory:
+        for server in servers.values():
+            server.reset()
+
+        tracemalloc.start()
+        try:
+            run()
+            result['peak'] = tracemalloc.get_traced_memory()[1]
+
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+
+def write_config(path, homeserver, zabbix_url):
+    host, port = homeserver.rsplit(':', 1)
+    config = {
+        'matrix': {'homeserver': host.split('//')[1], 'port': int(port),
+                   'username': 'bench', 'password': 'bench',
+                   'token': 'token', 'user_id': USER_ID,
+                   'domain': 'localhost', 'room': ROOM,
+                   'message_type': 'm.notice'},
+        'zabbix-bot': {ROOM: 'bench'},
+        'zabbix': {'bench': {'host': zabbix_url, 'username': 'bench',
+                             'password': 'bench', 'cache_ttl': 0}},
+        'colors': COLORS,
+    }
+    with open(path, 'w') as file_descriptor:
+        yaml.safe_dump(config, file_descriptor)
+
+    return config
+
+
+def run_size(size, homeserver, repeat, memory, skip_bot):
+    """Runs all cases against a fake Zabbix with `size` triggers.
+
+    :return: list of results
+    """
+    results = []
+    fake_zabbix = Fake('fake_zabbix.py', '--triggers', str(size))
+    servers = {'zabbix': fake_zabbix, 'matrix': homeserver}
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            config_path = os.path.join(directory, 'zabbix-bot.yaml')
+            config = write_config(config_path, homeserver.url,
+                                  fake_zabbix.url)
+            realm = config['zabbix']['bench']
+            # Log in up front, the login is not part of any case.
+            zabbix.init(realm)
+            for name, function in FUNCTIONS:
+                result = measure(lambda: function(realm, size), servers,
+                                 repeat, memory)
+                result.update(size=size, case='zabbix.' + name)
+                results.append(result)
+                report(result)
+
+            if not skip_bot:
+                bot = Bot(config_path, homeserver.url)
+                for args in COMMANDS:
+                    result = measure(lambda: bot.command(args), servers,
+                                     repeat, memory)
+                    result.update(size=size,
+                                  case=' '.join(['!zabbix', args]).strip())
+                    results.append(result)
+                    report(result)
+
+    finally:
+        fake_zabbix.stop()
+        zabbix._sessions.clear()
+
+    return results
+
+
+def header():
+    print('{0:>6} {1:<34} {2:>10} {3:>6} {4:>5} {5:>10} {6:>10} {7:>10}'
+          .format('size', 'case', 'wall ms', 'calls', 'http', 'zbx KiB',
+                  'mx KiB', 'peak KiB'))
+
+
+def report(result):
+    peak = result['peak']
+    print('{0:>6} {1:<34} {2:>10.1f} {3:>6} {4:>5} {5:>10.1f} {6:>10.1f} '
+          '{7:>10}'.format(
+              result['size'], result['case'][:34], result['wall'] * 1000,
+              result['total_calls'], result['zabbix_requests'],
+              result['zabbix_bytes'] / 1024, result['matrix_bytes'] / 1024,
+              '-' if peak is None else '{0:.0f}'.format(peak / 1024)))
+    sys.stdout.flush()
+
+
+def regressions(results, baseline, tolerance):
+    """Compares the results with those of an earlier run. More API calls
+    are always a regression, wall time and peak memory when they grew by
+    more than the tolerance factor.
+
+    :return: list of descriptions
+    """
+    earlier = {(result['size'], result['case']): result
+               for result in baseline}
+    found = []
+    for result in results:
+        old = earlier.get((result['size'], result['case']))
+        if old is None:
+            continue
+
+        name = '{0} at N={1}'.format(result['case'], result['size'])
+        if result['total_calls'] > old['total_calls']:
+            found.append('{0}: {1} API calls, was {2}'.format(
+                name, result['total_calls'], old['total_calls']))
+
+        if result['wall'] > old['wall'] * tolerance + SLACK:
+            found.append('{0}: {1:.1f} ms, was {2:.1f} ms'.format(
+                name, result['wall'] * 1000, old['wall'] * 1000))
+
+        if (result['peak'] is not None and old.get('peak') is not None and
+                result['peak'] > old['peak'] * tolerance):
+            found.append('{0}: peak {1:.0f} KiB, was {2:.0f} KiB'.format(
+                name, result['peak'] / 1024, old['peak'] / 1024))
+
+    return found
+
+
+def flags():
+    parser = argparse.ArgumentParser(
+        description='Offline benchmarks of the matrix-zabbix-bot.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=SIZES,
+                        help=('numbers of triggers to benchmark with '
+                              '(defaults to 10 100 1000 10000)'))
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='timed runs per case (defaults to 3)')
+    parser.add_argument('--no-memory', action='store_false', dest='memory',
+                        help='skip the peak memory runs')
+    parser.add_argument('--no-bot', action='store_true', dest='skip_bot',
+                        help='only benchmark the zabbix.py functions')
+    parser.add_argument('-o', '--output', type=str,
+                        help='writes the results as JSON to this file')
+    parser.add_argument('-b', '--baseline', type=str,
+                        help=('compares with the results in this file, '
+                              'exits with 1 on a regression'))
+    parser.add_argument('-t', '--tolerance', type=float, default=TOLERANCE,
+                        help=('factor by which wall time and memory may grow '
+                              '(defaults to {0})'.format(TOLERANCE)))
+    return vars(parser.parse_args())
+
+
+def main():
+    args = flags()
+    logging.basicConfig(level=logging.WARNING)
+    homeserver = Fake('fake_matrix.py')
+    results = []
+    try:
+        header()
+        for size in args['sizes']:
+            results += run_size(size, homeserver, args['repeat'],
+                                args['memory'], args['skip_bot'])
+
+    finally:
+        homeserver.stop()
+
+    if args['output']:
+        with open(args['output'], 'w') as file_descriptor:
+            json.dump(results, file_descriptor, indent=2)
+
+    if args['baseline']:
+        with open(args['baseline'], 'r') as file_descriptor:
+            found = regressions(results, json.load(file_descriptor),
+                                args['tolerance'])
+
+        for line in found:
+            print('REGRESSION ' + line)
+
+        if found:
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
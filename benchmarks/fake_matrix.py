@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Fake Matrix homeserver for the benchmarks. Implements just
+enough of the client-server API for matrix_client: login, sync, filters,
+joining rooms and sending messages. Sent messages are counted and kept.
+
+GET /_bench/stats returns the counters and the number of messages,
+POST /_bench/reset clears them.
+"""
+import argparse
+import json
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+PREFIX = '/_matrix/client/r0'
+
+SEND = re.compile(PREFIX + r'/rooms/([^/]+)/send/([^/]+)/([^/]+)$')
+JOIN = re.compile(PREFIX + r'/(?:join|rooms/([^/]+)/join)(?:/([^/]+))?$')
+FILTER = re.compile(PREFIX + r'/user/([^/]+)/filter$')
+
+EMPTY_SYNC = {
+    'rooms': {'join': {}, 'invite': {}, 'leave': {}},
+    'presence': {'events': []},
+    'account_data': {'events': []},
+    'to_device': {'events': []},
+}
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, Handler)
+        self.lock = threading.Lock()
+        self.batch = 0
+        self.filters = []
+        self.clear()
+
+    def clear(self):
+        self.messages = []
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def stats(self):
+        return {'messages': len(self.messages),
+                'requests': self.requests,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'filters': len(self.filters)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this every reply
+    # waits for the delayed ACK of the client.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/_bench/stats':
+            with self.server.lock:
+                return self._reply(self.server.stats(), count=False)
+
+        if path == '/_bench/messages':
+            with self.server.lock:
+                return self._reply(self.server.messages, count=False)
+
+        if path == PREFIX + '/sync':
+            with self.server.lock:
+                self.server.batch += 1
+                batch = 's{0}'.format(self.server.batch)
+
+            return self._reply(dict(EMPTY_SYNC, next_batch=batch))
+
+        self._reply({'errcode': 'M_UNRECOGNIZED'}, 404)
+
+    def do_POST(self):
+        body = self._body()
+        path = urlparse(self.path).path
+        if path == '/_bench/reset':
+            with self.server.lock:
+                self.server.clear()
+
+            return self._reply({}, count=False)
+
+        if path == PREFIX + '/login':
+            request = json.loads(body or b'{}')
+            user = request.get('user') or request.get(
+                'identifier', {}).get('user', 'bench')
+            return self._reply({'user_id': '@{0}:localhost'.format(user),
+                                'access_token': 'token',
+                                'home_server': 'localhost',
+                                'device_id': 'BENCH'})
+
+        match = JOIN.match(path)
+        if match is not None:
+            room = unquote(match.group(1) or match.group(2))
+            return self._reply({'room_id': room})
+
+        match = FILTER.match(path)
+        if match is not None:
+            with self.server.lock:
+                self.server.filters.append(json.loads(body or b'{}'))
+                filter_id = str(len(self.server.filters))
+
+            return self._reply({'filter_id': filter_id})
+
+        self._reply({'errcode': 'M_UNRECOGNIZED'}, 404)
+
+    def do_PUT(self):
+        body = self._body()
+        match = SEND.match(urlparse(self.path).path)
+        if match is None:
+            return self._reply({'errcode': 'M_UNRECOGNIZED'}, 404)
+
+        with self.server.lock:
+            self.server.messages.append({
+                'room': unquote(match.group(1)),
+                'type': unquote(match.group(2)),
+                'content': json.loads(body or b'{}')})
+            event_id = '$event{0}'.format(len(self.server.messages))
+
+        self._reply({'event_id': event_id})
+
+    def _body(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_in += len(body)
+
+        return body
+
+    def _reply(self, response, code=200, count=True):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            with self.server.lock:
+                self.server.bytes_out += len(body)
+
+
+def flags():
+    parser = argparse.ArgumentParser(description='Fake Matrix homeserver.')
+    parser.add_argument('-p', '--port', type=int, default=0,
+                        help='port to listen on (defaults to a free port)')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = flags()
+    server = Server(('127.0.0.1', args['port']))
+    # The benchmark reads the port from the first line.
+    print(server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Fake Zabbix JSON-RPC server for the benchmarks. Serves a
+generated set of hosts, groups, items and triggers and counts the calls and
+bytes per method.
+
+Besides /api_jsonrpc.php it answers GET /_bench/stats with the counters and
+POST /_bench/reset, which clears the counters and restores the data.
+"""
+import argparse
+import collections
+import fnmatch
+import json
+import math
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GROUPS = 10
+TRIGGERS_PER_HOST = 10
+KEYS = ['agent.ping', 'system.cpu.load', 'vfs.fs.size[/,pfree]']
+LASTCHANGE = 1700000000
+
+# Values per day of every item in the history, per trigger of the dataset.
+HISTORY_PER_TRIGGER = 10
+
+
+class Dataset(object):
+    """Deterministic Zabbix data for a number of triggers. Every fifth
+    trigger is in the OK state, every third problem is acknowledged.
+    """
+    def __init__(self, triggers):
+        self.size = triggers
+        self.reset()
+
+    def reset(self):
+        hosts = max(1, self.size // TRIGGERS_PER_HOST)
+        self.groups = [{'groupid': str(groupid), 'name': 'Group {0}'.format(
+            groupid)} for groupid in range(1, GROUPS + 1)]
+        self.hosts = [{'hostid': str(hostid),
+                       'host': 'host-{0:05d}'.format(hostid),
+                       'name': 'host-{0:05d}'.format(hostid),
+                       'description': '',
+                       'status': '0',
+                       'groupid': str(hostid % GROUPS + 1)}
+                      for hostid in range(1, hosts + 1)]
+        self.items = [{'itemid': str(hostid * len(KEYS) + index),
+                       'hostid': str(hostid),
+                       'key_': key,
+                       'name': key,
+                       'value_type': '0',
+                       'units': '',
+                       'lastvalue': str(hostid % 100),
+                       'prevvalue': str(hostid % 100),
+                       'lastclock': str(LASTCHANGE)}
+                      for hostid in range(1, hosts + 1)
+                      for index, key in enumerate(KEYS)]
+        self.triggers = []
+        for triggerid in range(1, self.size + 1):
+            hostid = (triggerid - 1) % hosts + 1
+            item = self.items[(hostid - 1) * len(KEYS) + triggerid % len(KEYS)]
+            self.triggers.append({
+                'triggerid': str(triggerid),
+                'description': '{HOST.NAME} benchmark trigger ' +
+                               str(triggerid),
+                'priority': str(triggerid % 6),
+                'value': '0' if triggerid % 5 == 0 else '1',
+                'lastchange': str(LASTCHANGE + triggerid),
+                'status': '0',
+                'hostid': str(hostid),
+                'itemid': item['itemid'],
+                'lastEvent': {'eventid': str(100000 + triggerid),
+                              'acknowledged':
+                                  '1' if triggerid % 3 == 0 else '0'}})
+
+        self.events = {trigger['lastEvent']['eventid']: trigger
+                       for trigger in self.triggers}
+        self.host_index = {host['hostid']: host for host in self.hosts}
+        self.item_index = {item['itemid']: item for item in self.items}
+
+    def trigger_get(self, params):
+        triggers = self.triggers
+        if 'triggerids' in params:
+            wanted = set(_ids(params['triggerids']))
+            triggers = [trigger for trigger in triggers
+                        if trigger['triggerid'] in wanted]
+
+        if 'hostids' in params:
+            wanted = set(_ids(params['hostids']))
+            triggers = [trigger for trigger in triggers
+                        if trigger['hostid'] in wanted]
+
+        if 'groupids' in params:
+            wanted = set(_ids(params['groupids']))
+            triggers = [trigger for trigger in triggers
+                        if self.host_index[trigger['hostid']]['groupid']
+                        in wanted]
+
+        if 'min_severity' in params:
+            triggers = [trigger for trigger in triggers
+                        if int(trigger['priority']) >=
+                        int(params['min_severity'])]
+
+        priorities = params.get('filter', {}).get('priority')
+        if priorities is not None:
+            wanted = {str(priority) for priority in _ids(priorities)}
+            triggers = [trigger for trigger in triggers
+                        if trigger['priority'] in wanted]
+
+        values = params.get('filter', {}).get('value')
+        if values is not None:
+            wanted = {str(value) for value in _ids(values)}
+            triggers = [trigger for trigger in triggers
+                        if trigger['value'] in wanted]
+
+        if params.get('withLastEventUnacknowledged'):
+            triggers = [trigger for trigger in triggers
+                        if trigger['lastEvent']['acknowledged'] == '0']
+
+        if 'lastChangeSince' in params:
+            triggers = [trigger for trigger in triggers
+                        if int(trigger['lastchange']) >
+                        int(params['lastChangeSince'])]
+
+        if params.get('sortfield') == 'priority':
+            triggers = sorted(triggers,
+                              key=lambda trigger: int(trigger['priority']),
+                              reverse=params.get('sortorder') == 'DESC')
+
+        if 'limit' in params:
+            triggers = triggers[:int(params['limit'])]
+
+        result = []
+        for trigger in triggers:
+            row = _output(trigger, params.get('output', 'extend'),
+                          ('hostid', 'itemid', 'lastEvent'))
+            if 'selectHosts' in params:
+                row['hosts'] = [_output(
+                    self.host_index[trigger['hostid']],
+                    params['selectHosts'], ('groupid',))]
+
+            if 'selectItems' in params:
+                row['items'] = [_output(
+                    self.item_index[trigger['itemid']],
+                    params['selectItems'])]
+
+            if 'selectLastEvent' in params:
+                row['lastEvent'] = _output(trigger['lastEvent'],
+                                           params['selectLastEvent'])
+
+            result.append(row)
+
+        return result
+
+    def host_get(self, params):
+        hosts = self.hosts
+        if 'hostids' in params:
+            wanted = set(_ids(params['hostids']))
+            hosts = [host for host in hosts if host['hostid'] in wanted]
+
+        if 'groupids' in params:
+            wanted = set(_ids(params['groupids']))
+            hosts = [host for host in hosts if host['groupid'] in wanted]
+
+        for key, value in params.get('filter', {}).items():
+            wanted = set(_ids(value))
+            hosts = [host for host in hosts if host[key] in wanted]
+
+        name = params.get('search', {}).get('name')
+        if name is not None:
+            pattern = name if params.get('searchWildcardsEnabled') else (
+                '*' + name + '*')
+            hosts = [host for host in hosts
+                     if fnmatch.fnmatch(host['name'], pattern)]
+
+        return [_output(host, params.get('output', 'extend'), ('groupid',))
+                for host in hosts]
+
+    def hostgroup_get(self, params):
+        return [_output(group, params.get('output', 'extend'))
+                for group in self.groups]
+
+    def item_get(self, params):
+        items = self.items
+        if 'hostids' in params:
+            wanted = set(_ids(params['hostids']))
+            items = [item for item in items if item['hostid'] in wanted]
+
+        if 'triggerids' in params:
+            wanted = {self.triggers[int(triggerid) - 1]['itemid']
+                      for triggerid in _ids(params['triggerids'])}
+            items = [item for item in items if item['itemid'] in wanted]
+
+        keys = params.get('filter', {}).get('key_')
+        if keys is not None:
+            wanted = set(_ids(keys))
+            items = [item for item in items if item['key_'] in wanted]
+
+        return [_output(item, params.get('output', 'extend'))
+                for item in items]
+
+    def _values(self, itemid, time_from, time_till):
+        """Yields (clock, value) of the generated history of an item.
+        """
+        step = 86400 / (self.size * HISTORY_PER_TRIGGER)
+        index = math.ceil(time_from / step)
+        while index * step < time_till + 1:
+            yield (int(index * step),
+                   50 + 40 * math.sin(index / 1000 + int(itemid)))
+            index += 1
+
+    def history_get(self, params):
+        values = self._values(params['itemids'],
+                              int(params.get('time_from', 0)),
+                              int(params['time_till']))
+        result = []
+        for clock, value in values:
+            if len(result) == int(params.get('limit', sys.maxsize)):
+                break
+
+            result.append(_output({'itemid': str(params['itemids']),
+                                   'clock': str(clock),
+                                   'value': '{0:.4f}'.format(value)},
+                                  params.get('output', 'extend')))
+
+        return result
+
+    def trend_get(self, params):
+        hours = {}
+        for clock, value in self._values(params['itemids'],
+                                         int(params['time_from']),
+                                         int(params['time_till'])):
+            hour = hours.setdefault(clock - clock % 3600, [])
+            hour.append(value)
+
+        return [_output({'itemid': str(params['itemids']),
+                         'clock': str(clock),
+                         'num': str(len(values)),
+                         'value_min': '{0:.4f}'.format(min(values)),
+                         'value_avg': '{0:.4f}'.format(
+                             sum(values) / len(values)),
+                         'value_max': '{0:.4f}'.format(max(values))},
+                        params.get('output', 'extend'))
+                for clock, values in sorted(hours.items())]
+
+    def event_get(self, params):
+        events = sorted(self.events.items(), key=lambda item: int(item[0]),
+                        reverse=params.get('sortorder') == 'DESC')
+        since = int(params.get('eventid_from', 0))
+        result = []
+        for eventid, trigger in events:
+            if int(eventid) < since:
+                continue
+
+            event = {'eventid': eventid,
+                     'clock': trigger['lastchange'],
+                     'value': trigger['value'],
+                     'name': trigger['description'].replace(
+                         '{HOST.NAME}',
+                         self.host_index[trigger['hostid']]['name']),
+                     'objectid': trigger['triggerid']}
+            row = _output(event, params.get('output', 'extend'))
+            if 'selectHosts' in params:
+                row['hosts'] = [_output(self.host_index[trigger['hostid']],
+                                        params['selectHosts'])]
+
+            if 'selectRelatedObject' in params:
+                row['relatedObject'] = _output(
+                    trigger, params['selectRelatedObject'])
+
+            result.append(row)
+
+        if 'limit' in params:
+            del result[int(params['limit']):]
+
+        return result
+
+    def event_acknowledge(self, params):
+        eventids = _ids(params['eventids'])
+        for eventid in eventids:
+            trigger = self.events.get(eventid)
+            if trigger is not None:
+                trigger['lastEvent']['acknowledged'] = '1'
+
+        return {'eventids': eventids}
+
+
+def _ids(value):
+    if isinstance(value, (list, tuple)):
+        return [str(item) for item in value]
+
+    return [str(value)]
+
+
+def _output(row, output, hidden=()):
+    if output == 'extend':
+        return {key: value for key, value in row.items()
+                if key not in hidden}
+
+    return {key: row[key] for key in output if key in row}
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, triggers, latency=0.0):
+        super().__init__(address, Handler)
+        self.data = Dataset(triggers)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.clear()
+
+    def clear(self):
+        self.calls = collections.Counter()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def stats(self):
+        return {'calls': dict(self.calls),
+                'total_calls': sum(self.calls.values()),
+                'requests': self.requests,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out}
+
+    def call(self, request):
+        method = request.get('method')
+        params = request.get('params') or {}
+        self.calls[method] += 1
+        if method == 'apiinfo.version':
+            return {'result': '5.0.0'}
+
+        if method == 'user.login':
+            token = 'token{0}'.format(len(self.tokens) + 1)
+            self.tokens.add(token)
+            return {'result': token}
+
+        if request.get('auth') not in self.tokens:
+            return {'error': {'code': -32602, 'message': 'Invalid params.',
+                              'data': 'Not authorised.'}}
+
+        handler = getattr(self.data, method.replace('.', '_'), None)
+        if handler is None:
+            return {'error': {'code': -32601, 'message': 'Method not found.',
+                              'data': method}}
+
+        return {'result': handler(params)}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, without this every reply
+    # waits for the delayed ACK of the client.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/_bench/stats':
+            with self.server.lock:
+                self._reply(self.server.stats())
+
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/_bench/reset':
+            with self.server.lock:
+                self.server.data.reset()
+                self.server.clear()
+                return self._reply({})
+
+        request = json.loads(body.decode('utf-8'))
+        # Simulates the network and the database of a real server.
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            if isinstance(request, list):
+                response = [dict(self.server.call(call), jsonrpc='2.0',
+                                 id=call.get('id')) for call in request]
+
+            else:
+                response = dict(self.server.call(request), jsonrpc='2.0',
+                                id=request.get('id'))
+
+            self.server.requests += 1
+            self.server.bytes_in += len(body)
+            length = self._reply(response)
+            self.server.bytes_out += length
+
+    def _reply(self, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+
+def flags():
+    parser = argparse.ArgumentParser(description='Fake Zabbix API server.')
+    parser.add_argument('-n', '--triggers', type=int, default=1000,
+                        help='number of triggers (defaults to 1000)')
+    parser.add_argument('-p', '--port', type=int, default=0,
+                        help='port to listen on (defaults to a free port)')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+                        help='seconds added to every request (defaults to 0)')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = flags()
+    server = Server(('127.0.0.1', args['port']), args['triggers'],
+                    args['latency'])
+    # The benchmark reads the port from the first line.
+    print(server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Alert relay daemon. Keeps one logged in Matrix client with the
+rooms joined and sends the alerts that matrix_alert.py hands over through a
+Unix socket.
+
+Protocol: the client writes one JSON object, {"room": .., "message": ..,
+"message_type": ..}, closes its writing side and reads a one line reply,
+"ok" or "error <reason>".
+"""
+import argparse
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+from matrix_client.errors import MatrixRequestError
+
+import matrix
+import matrix_alert
+import send_queue
+from matrix import set_log_level
+
+# Defaults of the coalesce section: seconds of quiet before a digest is sent,
+# alerts per digest and the longest an alert may be held back.
+COALESCE_WINDOW = 2
+COALESCE_MAX_ALERTS = 20
+COALESCE_MAX_DELAY = 10
+
+
+class Relay(object):
+    """Sends alerts with a single Matrix client, joined rooms are kept.
+    Messages go out through a send_queue.SendQueue.
+    """
+    def __init__(self, config, spool=None):
+        """
+        :param config: the configuration, as merged by matrix.merge_config
+        :type config: dict
+        :param spool: spool file of the send queue
+        :type spool: str
+        """
+        self.config = config['matrix']
+        self.colors = matrix_alert.color_table(config)
+        self.client = matrix.login(self.config)
+        self.rooms = {}
+        self.lock = threading.Lock()
+        self.outbox = send_queue.SendQueue(self._send, spool)
+        self.outbox.start()
+
+    def room(self, name):
+        """Returns the joined room, joining it the first time.
+
+        :param name: room name, None for the configured room
+        :type name: str
+        :return: MatrixClient.room
+        """
+        name = name or self.config['room']
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = matrix.join(self.client, self.config, name)
+                self.rooms[name] = room
+
+        return room
+
+    def deliver(self, name, message, message_type=None):
+        """Queues an (already formatted) message for a room.
+
+        :param name: room name, None for the configured room
+        :type name: str
+        :param message: the html message
+        :type message: str
+        :param message_type: overrides the configured message type
+        :type message_type: str
+        """
+        self.outbox.put(name, message, message_type)
+
+    def _send(self, name, message, message_type=None):
+        """Sends an (already formatted) message to a room.
+
+        :param name: room name, None for the configured room
+        :type name: str
+        :param message: the html message
+        :type message: str
+        :param message_type: overrides the configured message type
+        :type message_type: str
+        """
+        config = dict(self.config, message=message)
+        if message_type:
+            config['message_type'] = message_type
+
+        try:
+            matrix.send_message(config, self.room(name))
+
+        except MatrixRequestError as error:
+            # Other errors, like a rate limit, are retried by the outbox.
+            if error.code != 403:
+                raise
+
+            # The room may have been left or kicked us, join it once more.
+            with self.lock:
+                self.rooms.pop(name or self.config['room'], None)
+
+            matrix.send_message(config, self.room(name))
+
+    def send(self, alert):
+        """Colorizes and sends an alert.
+
+        :param alert: the alert as received from matrix_alert.py
+        :type alert: dict
+        """
+        self.deliver(alert.get('room'),
+                     matrix_alert.colorize(self.colors, alert['message']),
+                     alert.get('message_type'))
+
+
+class Coalescer(object):
+    """Merges the alerts that arrive for a room within a short window into
+    one digest, sorted by severity. Disaster alerts are sent right away.
+
+    send() returns once the digest holding the alert is queued in the
+    outbox, and so in its spool, so the client is only told `ok` for
+    alerts that survive a restart of the relay.
+    """
+    def __init__(self, relay, window=COALESCE_WINDOW,
+                 max_alerts=COALESCE_MAX_ALERTS, max_delay=COALESCE_MAX_DELAY):
+        """
+        :param relay: the relay to send the digests with
+        :type relay: Relay
+        :param window: seconds without new alerts before sending
+        :type window: float
+        :param max_alerts: send once this many alerts are waiting
+        :type max_alerts: int
+        :param max_delay: seconds an alert may wait at most
+        :type max_delay: float
+        """
+        self.relay = relay
+        self.window = window
+        self.max_alerts = max_alerts
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def send(self, alert):
+        """Adds the alert to the digest of its room and waits until the
+        digest is queued.
+
+        :param alert: the alert as received from matrix_alert.py
+        :type alert: dict
+        """
+        severity = self.relay.colors.severity(alert['message'])
+        if severity == 'disaster':
+            return self.relay.send(alert)
+
+        key = (alert.get('room'), alert.get('message_type'))
+        now = time.time()
+        with self.lock:
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = {'first': now, 'alerts': [], 'timer': None,
+                         'queued': threading.Event(), 'error': None}
+                self.pending[key] = batch
+
+            batch['alerts'].append((severity, alert['message']))
+            if batch['timer'] is not None:
+                batch['timer'].cancel()
+
+            if len(batch['alerts']) >= self.max_alerts:
+                delay = 0
+
+            else:
+                delay = min(self.window,
+                            batch['first'] + self.max_delay - now)
+
+            batch['timer'] = threading.Timer(max(delay, 0), self.flush,
+                                             args=(key, batch))
+            batch['timer'].daemon = True
+            batch['timer'].start()
+
+        if not batch['queued'].wait(self.max_delay + self.window + 5):
+            raise RuntimeError('the digest was not queued in time')
+
+        if batch['error'] is not None:
+            raise batch['error']
+
+    def flush(self, key, batch):
+        """Sends the waiting alerts of a room as one message.
+        """
+        with self.lock:
+            if self.pending.get(key) is not batch:
+                return
+
+            del self.pending[key]
+
+        try:
+            alerts = sorted(batch['alerts'], key=_severity_rank,
+                            reverse=True)
+            logging.debug('sending %d coalesced alerts to %s', len(alerts),
+                          key)
+            message = '<br />'.join(
+                matrix_alert.colorize_priority(self.relay.colors, severity,
+                                               message)
+                for severity, message in alerts)
+            self.relay.deliver(key[0], message, key[1])
+
+        except Exception as error:  # Keep running!
+            logging.error(error, exc_info=True)
+            batch['error'] = error
+
+        finally:
+            batch['queued'].set()
+
+
+def _severity_rank(alert):
+    """Sort key of a (severity, message) alert. Colors other than the Zabbix
+    severities, e.g. `resolved`, go last.
+    """
+    if alert[0] in matrix_alert.SEVERITIES:
+        return matrix_alert.SEVERITIES.index(alert[0])
+
+    return -1
+
+
+class AlertHandler(socketserver.StreamRequestHandler):
+    """Handles one alert per connection.
+    """
+    def handle(self):
+        try:
+            alert = json.loads(self.rfile.read().decode('utf-8'))
+            logging.debug('received alert: %s', alert)
+            self.server.relay.send(alert)
+            reply = 'ok'
+
+        except Exception as error:  # Keep running!
+            logging.error(error, exc_info=True)
+            reply = 'error {0}'.format(error)
+
+        self.wfile.write('{0}\n'.format(reply).encode('utf-8'))
+
+
+def serve(relay, path, mode=0o660):
+    """Listens on the Unix socket until interrupted.
+
+    :param relay: the relay to send the alerts with
+    :type relay: Relay or Coalescer
+    :param path: path of the socket
+    :type path: str
+    :param mode: permissions of the socket
+    :type mode: int
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, AlertHandler)
+    server.daemon_threads = True
+    server.relay = relay
+    os.chmod(path, mode)
+    logging.info('relaying alerts from %s', path)
+    try:
+        server.serve_forever()
+
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def flags():
+    """Parses the arguments given.
+
+    :return: dictionary of the arguments
+    """
+    parser = argparse.ArgumentParser(description='Alert relay for Matrix.')
+    parser.add_argument('-c', '--config', type=str, dest='config',
+                        default='/etc/zabbix-bot.yaml',
+                        help=('specifies the config file '
+                              '(defaults to /etc/zabbix-bot.yaml)'))
+    parser.add_argument('-s', '--socket', type=str, dest='socket',
+                        help=('socket to listen on (overrides the config, '
+                              'defaults to {0})'.format(matrix.RELAY_SOCKET)))
+    parser.add_argument('-d', '--debug', action='store_const', dest='debug',
+                        const=True, default=False,
+                        help='enables the debug output')
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = flags()
+    if args['debug'] is True:
+        set_log_level('DEBUG')
+
+    else:
+        set_log_level()
+
+    config = matrix.merge_config({}, matrix.read_config(args['config']))
+    relay_config = config.get('relay', {})
+    socket_path = (args['socket'] or
+                   relay_config.get('socket', matrix.RELAY_SOCKET))
+    mode = relay_config.get('mode', 0o660)
+    if isinstance(mode, str):
+        mode = int(mode, 8)
+
+    relay = Relay(config, relay_config.get('spool'))
+    if 'coalesce' in relay_config:
+        coalesce = relay_config['coalesce'] or {}
+        relay = Coalescer(
+            relay,
+            window=float(coalesce.get('window', COALESCE_WINDOW)),
+            max_alerts=int(coalesce.get('max_alerts', COALESCE_MAX_ALERTS)),
+            max_delay=float(coalesce.get('max_delay', COALESCE_MAX_DELAY)))
+
+    serve(relay, socket_path, mode)
@@ -0,0 +1,113 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Configuration snapshots for the matrix-zabbix-bot. The YAML
+file is parsed once into an immutable snapshot, which is replaced when the
+file changes or on SIGHUP.
+"""
+import collections
+import logging
+import os
+import threading
+from types import MappingProxyType
+
+import matrix
+import matrix_alert
+
+Snapshot = collections.namedtuple(
+    'Snapshot', ['path', 'mtime', 'raw', 'rooms', 'realms', 'matrix',
+                 'colors'])
+Snapshot.__doc__ = """Immutable, preprocessed configuration.
+
+rooms maps a Matrix room id to a tuple of its Zabbix realms, realms maps a
+realm to its connection settings and colors is the
+matrix_alert.ColorTable."""
+
+
+def _freeze(mapping):
+    return MappingProxyType(dict(mapping))
+
+
+def _realms(realms):
+    """A room maps to one realm or a list of realms.
+    """
+    if isinstance(realms, str):
+        return (realms,)
+
+    return tuple(realms)
+
+
+def load(path):
+    """Reads the config file into a Snapshot.
+
+    :param path: path to the config file
+    :type path: str
+    :return: Snapshot
+    """
+    path = os.path.expanduser(path)
+    mtime = os.stat(path).st_mtime
+    raw = matrix.read_config(path)
+    return Snapshot(
+        path=path,
+        mtime=mtime,
+        raw=raw,
+        rooms=_freeze({room: _realms(realms)
+                       for room, realms in raw['zabbix-bot'].items()}),
+        realms=_freeze({realm: _freeze(settings)
+                        for realm, settings in raw['zabbix'].items()}),
+        matrix=_freeze(raw['matrix']),
+        colors=matrix_alert.color_table(raw))
+
+
+class ConfigHolder(object):
+    """Holds the current Snapshot. Commands take the snapshot once with
+    get() and keep using it, a reload only affects later commands.
+    """
+    def __init__(self, path, on_reload=None):
+        """
+        :param path: path to the config file
+        :type path: str
+        :param on_reload: called with the new Snapshot after a reload
+        :type on_reload: callable
+        """
+        self.current = load(path)
+        self.mtime = self.current.mtime
+        self.on_reload = on_reload
+        self.lock = threading.Lock()
+
+    def get(self):
+        """Returns the current snapshot, reloading it first when the file
+        changed on disk.
+
+        :return: Snapshot
+        """
+        try:
+            changed = os.stat(self.current.path).st_mtime != self.mtime
+
+        except OSError:
+            changed = False
+
+        if changed:
+            self.reload()
+
+        return self.current
+
+    def reload(self, *_):
+        """Replaces the snapshot with a fresh one. A broken config file is
+        logged and the old snapshot is kept. Can be used as signal handler.
+        """
+        path = self.current.path
+        with self.lock:
+            try:
+                self.mtime = os.stat(path).st_mtime
+                self.current = load(path)
+                logging.info('reloaded %s', path)
+
+            except Exception as error:  # Keep running!
+                logging.error('not reloading %s: %s', path, error)
+                return
+
+            if self.on_reload is not None:
+                try:
+                    self.on_reload(self.current)
+
+                except Exception as error:  # Keep running!
+                    logging.error(error, exc_info=True)
@@ -0,0 +1,125 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Short lived snapshot cache for the matrix-zabbix-bot.
+Concurrent requests for the same key share a single fetch.
+"""
+import logging
+import threading
+import time
+
+import metrics
+
+# Entries kept at most, the oldest are dropped first. Every filter a user
+# types gets its own entry.
+MAX_ENTRIES = 256
+
+
+class _Flight(object):
+    """A fetch in progress, other requesters wait for its outcome.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SnapshotCache(object):
+    """Caches values for `ttl` seconds. Identical requests that arrive while
+    a value is being fetched wait for that fetch instead of starting their
+    own. Expired entries are dropped when a value is stored.
+    """
+    def __init__(self, ttl, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.flights = {}
+        self.generation = 0
+
+    def get(self, key, fetch):
+        """Returns the cached value for key, calling fetch() when there is no
+        fresh value.
+
+        :param key: cache key
+        :type key: hashable
+        :param fetch: function returning the value
+        :type fetch: callable
+        :return: the (cached) value
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl:
+                logging.debug('cache hit for %s', key)
+                metrics.CACHE.inc(cache=_name(key), result='hit')
+                return entry[1]
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.flights[key] = flight
+                generation = self.generation
+
+        metrics.CACHE.inc(cache=_name(key),
+                          result='miss' if leader else 'shared')
+        if not leader:
+            logging.debug('waiting for in-flight fetch of %s', key)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.value
+
+        try:
+            flight.value = fetch()
+            with self.lock:
+                # Do not store values fetched before an invalidation.
+                if generation == self.generation:
+                    self._store(key, flight.value)
+
+            return flight.value
+
+        except Exception as error:
+            flight.error = error
+            raise
+
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+            flight.done.set()
+
+    def _store(self, key, value):
+        """Stores a value and drops the expired entries and those over
+        max_entries. Called with the lock held.
+        """
+        now = time.time()
+        # Entries stay in the order they were stored, oldest first.
+        self.entries.pop(key, None)
+        self.entries[key] = (now, value)
+        for old in list(self.entries):
+            if (len(self.entries) <= self.max_entries and
+                    now - self.entries[old][0] <= self.ttl):
+                break
+
+            del self.entries[old]
+
+    def invalidate(self, key=None):
+        """Drops the cached value for key, or all values without a key.
+
+        :param key: cache key
+        :type key: hashable
+        """
+        with self.lock:
+            self.generation += 1
+            if key is None:
+                self.entries.clear()
+
+            else:
+                self.entries.pop(key, None)
+
+
+def _name(key):
+    """Returns the metrics label of a cache key, the first element of a tuple
+    key names the kind of entry.
+    """
+    return key[0] if isinstance(key, tuple) else key
@@ -0,0 +1,213 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Worker pool for the matrix-zabbix-bot. Commands run outside the
+Matrix sync thread while the replies keep the order of the commands per room.
+"""
+import collections
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+WORKERS = 8
+PER_REALM = 2
+
+# Threads shared by all commands for querying several realms at once.
+FAN_OUT_WORKERS = 16
+
+_fan_out = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS,
+                              thread_name_prefix='fan-out')
+
+# The realm whose slot the current thread holds.
+_held = threading.local()
+
+
+class CommandPool(object):
+    """Runs commands on a bounded pool of threads, with at most `per_realm`
+    commands in flight per Zabbix realm. Commands for a busy realm wait in a
+    queue without occupying a thread. The results are handed to `deliver` in
+    the order the commands were submitted for a room.
+
+    Commands for several realms are submitted without a realm, their work
+    per realm takes a slot of that realm through fan_out. A command that
+    fans out to other realms gives up its own slot first, waiting for a
+    slot while holding one could deadlock with a command doing the reverse.
+    """
+    def __init__(self, deliver, workers=WORKERS, per_realm=PER_REALM):
+        """
+        :param deliver: called with (room, future) once a command is done
+        :type deliver: callable
+        :param workers: number of worker threads
+        :type workers: int
+        :param per_realm: concurrent commands per realm
+        :type per_realm: int
+        """
+        self.deliver = deliver
+        self.per_realm = per_realm
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='command')
+        self.lock = threading.Lock()
+        self.running = collections.Counter()
+        self.queued = collections.defaultdict(collections.deque)
+        self.pending = collections.defaultdict(collections.deque)
+        self.room_locks = collections.defaultdict(threading.Lock)
+
+    def submit(self, room, realm, function, *args):
+        """Queues function(*args) for the room.
+
+        :param room: matrix room reference
+        :type room: matrix room object
+        :param realm: the Zabbix realm the command queries, None for a
+                      command that does not take a slot itself
+        :type realm: str
+        :param function: the command
+        :type function: callable
+        :return: future of the command
+        """
+        future = Future()
+        with self.lock:
+            self.pending[room.room_id].append((room, future))
+            self.room_locks[room.room_id]
+            self.queued[realm].append((future, function, args,
+                                       self.executor))
+
+        logging.debug('queued command for %s (realm %s)', room.room_id, realm)
+        future.add_done_callback(lambda _: self._flush(room.room_id))
+        self._schedule(realm)
+        return future
+
+    def fan_out(self, function, items):
+        """Calls function(realm, ...) for all items concurrently and waits
+        for all of them, see the module function fan_out. Calls for the
+        realm of the calling command use its slot. When other realms are
+        involved the slot is released and every call waits for a slot of
+        its realm.
+
+        :param function: the function to call
+        :type function: callable
+        :param items: argument tuples starting with the realm
+        :type items: iterable
+        :return: list of (result, error) tuples in the order of the items
+        """
+        items = list(items)
+        held = getattr(_held, 'realm', None)
+        if held is not None and all(item[0] == held for item in items):
+            return fan_out(function, items)
+
+        if held is not None:
+            self._release()
+
+        futures = []
+        for item in items:
+            future = Future()
+            with self.lock:
+                self.queued[item[0]].append((future, function, item,
+                                             _fan_out))
+
+            self._schedule(item[0])
+            futures.append(future)
+
+        return _results(futures)
+
+    def _schedule(self, realm):
+        """Starts queued work of the realm while it has free slots.
+        """
+        with self.lock:
+            while (self.queued[realm] and
+                   (realm is None or
+                    self.running[realm] < self.per_realm)):
+                self.running[realm] += 1
+                future, function, args, executor = \
+                    self.queued[realm].popleft()
+                executor.submit(self._run, realm, future, function, args)
+
+    def _release(self):
+        """Frees the slot held by the current thread.
+        """
+        realm = _held.realm
+        _held.realm = None
+        _held.released = True
+        with self.lock:
+            self.running[realm] -= 1
+
+        self._schedule(realm)
+
+    def _run(self, realm, future, function, args):
+        _held.released = False
+        if not future.set_running_or_notify_cancel():
+            result = error = None
+
+        else:
+            _held.realm = realm
+            try:
+                result, error = function(*args), None
+
+            except Exception as exception:
+                result, error = None, exception
+
+            finally:
+                _held.realm = None
+
+        if not _held.released:
+            with self.lock:
+                self.running[realm] -= 1
+
+            self._schedule(realm)
+
+        if error is not None:
+            future.set_exception(error)
+
+        elif future.running():
+            future.set_result(result)
+
+    def _flush(self, room_id):
+        """Delivers the finished commands at the head of the room's queue.
+        """
+        with self.room_locks[room_id]:
+            while True:
+                with self.lock:
+                    queue = self.pending[room_id]
+                    if not queue or not queue[0][1].done():
+                        return
+
+                    room, future = queue.popleft()
+
+                try:
+                    self.deliver(room, future)
+
+                except Exception as error:  # Keep running!
+                    logging.error(error, exc_info=True)
+
+
+def fan_out(function, items):
+    """Calls function(*item) for all items concurrently and waits for all
+    of them, so the time taken is that of the slowest call.
+
+    :param function: the function to call
+    :type function: callable
+    :param items: argument tuples
+    :type items: iterable
+    :return: list of (result, error) tuples in the order of the items
+    """
+    items = list(items)
+    if len(items) == 1:
+        # Nothing to wait for concurrently, skip the thread hop.
+        try:
+            return [(function(*items[0]), None)]
+
+        except Exception as error:
+            return [(None, error)]
+
+    return _results([_fan_out.submit(function, *item) for item in items])
+
+
+def _results(futures):
+    """Waits for the futures, returns their (result, error) tuples.
+    """
+    results = []
+    for future in futures:
+        try:
+            results.append((future.result(), None))
+
+        except Exception as error:
+            results.append((None, error))
+
+    return results
@@ -0,0 +1,174 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    History graphs for the matrix-zabbix-bot. Item values are
+downsampled a page at a time into a fixed number of min/avg/max buckets, so
+memory does not grow with the window, and drawn as a Unicode sparkline.
+
+The downsampling uses NumPy when it is installed
+(pip install matrix-zabbix-bot[graph]), otherwise a plain loop.
+"""
+import math
+import re
+
+try:
+    import numpy
+
+except ImportError:
+    numpy = None
+
+# Number of buckets, and so characters, of a sparkline.
+BUCKETS = 60
+
+BARS = '▁▂▃▄▅▆▇█'
+
+# A window like 30m, 6h or 2w.
+WINDOW = re.compile(r'^(\d+)([smhdw])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+MAX_WINDOW = 366 * 86400
+
+
+def parse_window(value):
+    """Parses a window like '30m', '6h' or '2w'.
+
+    :param value: the window
+    :type value: str
+    :return: seconds
+    """
+    match = WINDOW.match(value)
+    if match is None:
+        raise ValueError('invalid window "{0}", use e.g. 30m, 6h, 2d or '
+                         '1w'.format(value))
+
+    seconds = int(match.group(1)) * UNITS[match.group(2)]
+    if not 0 < seconds <= MAX_WINDOW:
+        raise ValueError('window "{0}" is out of range'.format(value))
+
+    return seconds
+
+
+class Downsampler(object):
+    """Folds (clock, value) pages into buckets of equal duration over
+    [time_from, time_till), keeping the minimum, maximum, sum and count per
+    bucket.
+    """
+    def __init__(self, time_from, time_till, buckets=BUCKETS):
+        """
+        :param time_from: start of the window, unix time
+        :type time_from: int
+        :param time_till: end of the window, unix time
+        :type time_till: int
+        :param buckets: number of buckets
+        :type buckets: int
+        """
+        self.time_from = time_from
+        self.span = max(time_till - time_from, 1)
+        self.size = buckets
+        self.values = 0
+        if numpy is not None:
+            self.minimum = numpy.full(buckets, numpy.inf)
+            self.maximum = numpy.full(buckets, -numpy.inf)
+            self.sum = numpy.zeros(buckets)
+            self.count = numpy.zeros(buckets)
+
+        else:
+            self.minimum = [math.inf] * buckets
+            self.maximum = [-math.inf] * buckets
+            self.sum = [0.0] * buckets
+            self.count = [0] * buckets
+
+    def add_history(self, rows):
+        """Adds a page of history.get rows.
+
+        :param rows: rows with clock and value
+        :type rows: list
+        """
+        clocks = [row['clock'] for row in rows]
+        values = [row['value'] for row in rows]
+        self.add(clocks, values, values, values, [1] * len(rows))
+
+    def add_trends(self, rows):
+        """Adds a page of trend.get rows, hourly aggregates of num values.
+
+        :param rows: rows with clock, num, value_min, value_avg and
+                     value_max
+        :type rows: list
+        """
+        self.add([row['clock'] for row in rows],
+                 [row['value_min'] for row in rows],
+                 [row['value_max'] for row in rows],
+                 [float(row['value_avg']) * int(row['num']) for row in rows],
+                 [row['num'] for row in rows])
+
+    def add(self, clocks, minimums, maximums, sums, counts):
+        """Adds aggregates to the buckets of their clocks. Numbers may be
+        given as strings, as Zabbix returns them.
+        """
+        if not clocks:
+            return
+
+        if numpy is None:
+            self._add_loop(clocks, minimums, maximums, sums, counts)
+            return
+
+        clocks = numpy.asarray(clocks, dtype=numpy.int64)
+        index = numpy.clip((clocks - self.time_from) * self.size // self.span,
+                           0, self.size - 1)
+        counts = numpy.asarray(counts, dtype=numpy.float64)
+        numpy.minimum.at(self.minimum, index,
+                         numpy.asarray(minimums, dtype=numpy.float64))
+        numpy.maximum.at(self.maximum, index,
+                         numpy.asarray(maximums, dtype=numpy.float64))
+        self.sum += numpy.bincount(
+            index, numpy.asarray(sums, dtype=numpy.float64), self.size)
+        self.count += numpy.bincount(index, counts, self.size)
+        self.values += int(counts.sum())
+
+    def _add_loop(self, clocks, minimums, maximums, sums, counts):
+        for clock, low, high, total, count in zip(clocks, minimums, maximums,
+                                                  sums, counts):
+            index = (int(clock) - self.time_from) * self.size // self.span
+            index = min(max(index, 0), self.size - 1)
+            self.minimum[index] = min(self.minimum[index], float(low))
+            self.maximum[index] = max(self.maximum[index], float(high))
+            self.sum[index] += float(total)
+            self.count[index] += int(count)
+            self.values += int(count)
+
+    def summary(self):
+        """Returns the minimum, average and maximum of all values, None
+        without values.
+
+        :return: (min, avg, max) or None
+        """
+        if not self.values:
+            return None
+
+        return (float(min(self.minimum)), float(sum(self.sum)) / self.values,
+                float(max(self.maximum)))
+
+    def buckets(self):
+        """Returns (min, avg, max) per bucket, None for empty buckets.
+        """
+        return [(float(low), float(total) / count, float(high))
+                if count else None
+                for low, high, total, count in zip(
+                    self.minimum, self.maximum, self.sum, self.count)]
+
+
+def sparkline(buckets):
+    """Draws the averages of the buckets, scaled from their lowest to their
+    highest value. Empty buckets are blank.
+
+    :param buckets: as returned by Downsampler.buckets
+    :type buckets: list
+    :return: str
+    """
+    averages = [bucket[1] for bucket in buckets if bucket is not None]
+    if not averages:
+        return ''
+
+    low = min(averages)
+    scale = (len(BARS) - 1) / ((max(averages) - low) or 1)
+    return ''.join(' ' if bucket is None else
+                   BARS[int(round((bucket[1] - low) * scale))]
+                   for bucket in buckets)
+
@@ -4,19 +4,17 @@ Description:    Simple wrapper around matrix-python-sdk. Makes sending messages
                 to a Matrix room easy.
 
 Matrix-Python-SDK: https://github.com/matrix-org/matrix-python-sdk
+
+The alert scripts import this module once per alert, so yaml, matrix_client
+(with requests) and the metrics are only imported when they are used.
 """
 import argparse
-import imp
 import logging
 import os
 
-from matrix_client.client import MatrixClient
-from yaml import load
-try:
-    from yaml import CLoader as Loader
-
-except ImportError:
-    from yaml import Loader
+# Unix socket of the alert relay daemon (alert_relay.py).
+RELAY_SOCKET = os.environ.get('ZABBIX_BOT_RELAY_SOCKET',
+                              '/run/zabbix-bot/relay.sock')
 
 
 def flags():
@@ -39,6 +37,10 @@ def flags():
                               '(defaults to /etc/zabbix-bot.yaml)'))
     parser.add_argument('-t', '--type', type=str, dest='message_type',
                         help=('sets the message type'))
+    parser.add_argument('-s', '--socket', type=str, dest='socket',
+                        help=('socket of the alert relay daemon (defaults '
+                              'to {0}, then socket in the relay section of '
+                              'the config)'.format(RELAY_SOCKET)))
     parser.add_argument('-d', '--debug', action='store_const', dest='debug',
                         const=True, default=False,
                         help='enables the debug output')
@@ -59,6 +61,13 @@ def read_config(config_file):
         raise FileNotFoundError('config file "{0}" not found'.format(
             config_file))
 
+    from yaml import load
+    try:
+        from yaml import CLoader as Loader
+
+    except ImportError:
+        from yaml import Loader
+
     with open(config_file, 'r') as file_descriptor:
         config = load(file_descriptor, Loader=Loader)
 
@@ -85,9 +94,15 @@ def merge_config(args, config):
     return config
 
 
-def setup(config):
-    """Sets up the Matrix client. Makes sure the (specified) room is joined.
+def login(config):
+    """Sets up the Matrix client, logging in with the token or the password.
+
+    :param config: the matrix configuration
+    :type config: dict
+    :return: MatrixClient
     """
+    from matrix_client.client import MatrixClient
+
     loginargs = {}
     if 'token' in config:
         loginargs['user_id'] = '@{0}:{1}'.format(
@@ -101,8 +116,29 @@ def setup(config):
         client.login_with_password(
             username=config['username'], password=config['password'])
 
-    room = client.join_room('{0}:{1}'.format(
-        config['room'], config['domain']))
+    return client
+
+
+def join(client, config, room=None):
+    """Joins a room of the configured domain.
+
+    :param client: the Matrix client
+    :type client: MatrixClient
+    :param config: the matrix configuration
+    :type config: dict
+    :param room: room to join (defaults to the configured room)
+    :type room: str
+    :return: MatrixClient.room
+    """
+    return client.join_room('{0}:{1}'.format(
+        room or config['room'], config['domain']))
+
+
+def setup(config):
+    """Sets up the Matrix client. Makes sure the (specified) room is joined.
+    """
+    client = login(config)
+    room = join(client, config)
     return client, room
 
 
@@ -114,9 +150,17 @@ def send_message(config, room):
     :param room: reference to the Matrix room
     :type room: MatrixClient.room
     """
+    import metrics
+
     message = config['message']
     logging.debug('sending message:\n%s', message)
-    room.send_html(message, msgtype=config['message_type'])
+    try:
+        with metrics.MATRIX_SENDS.time():
+            room.send_html(message, msgtype=config['message_type'])
+
+    except Exception:
+        metrics.MATRIX_FAILURES.inc()
+        raise
 
 
 def set_log_level(level='INFO'):
@@ -126,9 +170,8 @@ def set_log_level(level='INFO'):
     :param level: level to be passed to logging (defaults to 'INFO')
     :type level: str
     """
-    imp.reload(logging)
     logging.basicConfig(format='%(asctime)s: %(levelname)8s - %(message)s',
-                        level=level)
+                        level=level, force=True)
 
 
 if __name__ == '__main__':
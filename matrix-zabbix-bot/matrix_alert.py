@@ -4,36 +4,256 @@ Description:    Zabbix alert script for matrix.
 This script expects the `matrix_zabbix_bot' import is available.
 """
 import re
+import json
 import logging
 import locale
-import pdb
+import os
+import socket
+import sys
+
 import matrix
 
+# Zabbix severities, from low to high.
+SEVERITIES = ['not classified', 'information', 'warning', 'average', 'high',
+              'disaster']
+
+# Seconds to wait for a connection to the relay daemon before sending
+# directly, and for its reply. The reply may wait for a coalesced digest to
+# be queued (max_delay of the coalesce section).
+CONNECT_TIMEOUT = 2
+RELAY_TIMEOUT = 30
+
+# Seconds the imports of this script may take, the fast path of an alert
+# only needs the standard library. Checked by --self-check.
+STARTUP_BUDGET = 0.05
+
+# Modules only a direct send may import, not the path to the relay.
+DIRECT_IMPORTS = ('yaml', 'matrix_client', 'requests')
+
+
+class ColorTable(object):
+    """Severity to (color, emoji) table, built once from the color
+    configuration. Severities in a message are found with one precompiled
+    regex.
+    """
+    def __init__(self, color_config):
+        """
+        :param color_config: {severity: 'color,emoji'}
+        :type color_config: dict
+        """
+        self.colors = {}
+        for level, color in color_config.items():
+            color, emoji = color.split(',')
+            self.colors[level.lower()] = (color, emoji)
+
+        levels = sorted(self.colors, key=len, reverse=True)
+        self.regex = re.compile(
+            '|'.join(re.escape(level) for level in levels), re.IGNORECASE)
+
+    def lookup(self, level):
+        """Returns the (color, emoji) of a severity, e.g. 'High'.
+        """
+        color = self.colors.get(level.lower())
+        if color is None:
+            color = self.colors['not classified']
+
+        return color
+
+    def severity(self, message):
+        """Returns the first severity named in the message, in lower case.
+        """
+        match = self.regex.search(message)
+        if match is None:
+            return 'not classified'
+
+        return match.group(0).lower()
+
+    def detect(self, message):
+        """Returns the (color, emoji) of the first severity named in the
+        message.
+        """
+        return self.colors[self.severity(message)]
+
+
+def color_table(config):
+    """Builds the ColorTable from the `zabbix_*` entries of the colors
+    section of the configuration.
+
+    :param config: the configuration
+    :type config: dict
+    :return: ColorTable
+    """
+    color_config = {}
+    for key, value in config['colors'].items():
+        if key.startswith('zabbix'):
+            key = key.replace('zabbix_', '')
+            color_config[key] = value
+
+    return ColorTable(color_config)
+
+
+def _format(color, emoji, message):
+    return '<font color=\"{0}\">{1} {2}</font>'.format(
+        color, emoji, message)
+
 
 def colorize(color_config, message):
     """Colorize a message based upon the severity of the message.
 
     :param color_config: the color configuration
-    :type color_config: dict
+    :type color_config: ColorTable or dict
     :param message: the message to color
     :type message: str
     :return: colorized message
     """
-    for level, color in color_config.items():
-        regex = re.compile('{0}'.format(level), re.IGNORECASE)
-        if regex.search(message):
-            color, emoji = color.split(',')
-            break
+    if not isinstance(color_config, ColorTable):
+        color_config = ColorTable(color_config)
 
-    else:
-        color, emoji = color_config['not classified'].split(',')
+    color, emoji = color_config.detect(message)
+    return _format(color, emoji, message)
 
-    formatted_message = '<font color=\"{0}\">{1} {2}</font>'.format(
-        color, emoji, message)
-    return formatted_message
+
+def colorize_priority(colors, priority, message):
+    """Colorize a message of which the severity is already known.
+
+    :param colors: the color table
+    :type colors: ColorTable
+    :param priority: the severity, e.g. 'High'
+    :type priority: str
+    :param message: the message to color
+    :type message: str
+    :return: colorized message
+    """
+    color, emoji = colors.lookup(priority)
+    return _format(color, emoji, message)
+
+
+def relay(socket_path, alert, timeout=RELAY_TIMEOUT):
+    """Hands the alert to the relay daemon (alert_relay.py).
+
+    :param socket_path: the Unix socket of the daemon
+    :type socket_path: str
+    :param alert: dictionary with the room, message and message_type
+    :type alert: dict
+    :param timeout: seconds to wait for the reply of the daemon
+    :type timeout: float
+    :return: False when the alert should be sent directly
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(socket_path)
+            sock.settimeout(timeout)
+            sock.sendall(json.dumps(alert).encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+
+        except OSError as error:
+            # The daemon did not get the whole alert.
+            logging.debug('relay at %s unavailable: %s', socket_path, error)
+            return False
+
+        try:
+            reply = sock.makefile('rb').readline().decode('utf-8').strip()
+
+        except OSError as error:
+            # The daemon has the alert and may still send it, sending it
+            # directly as well could post it twice.
+            logging.error('no reply from the relay at %s, not sending the '
+                          'alert again: %s', socket_path, error)
+            return True
+
+    if reply != 'ok':
+        logging.warning('relay failed to send the alert: %s', reply)
+
+    return reply == 'ok'
+
+
+def self_check(budget=STARTUP_BUDGET, top=10):
+    """Runs this script in a fresh interpreter the way Zabbix does, without
+    -s, against a stand-in relay on ZABBIX_BOT_RELAY_SOCKET. Reports the
+    time of the imports after the interpreter startup and the slowest
+    imports as measured by `python -X importtime`. The run as a whole
+    depends on the host and is only reported.
+
+    :param budget: allowed import time in seconds
+    :type budget: float
+    :param top: number of imports to show
+    :type top: int
+    :return: True when within the budget, without DIRECT_IMPORTS and the
+             alert reached the relay
+    """
+    import subprocess
+    import tempfile
+    import threading
+    import time
+
+    with tempfile.TemporaryDirectory() as directory, \
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        socket_path = os.path.join(directory, 'relay.sock')
+        server.bind(socket_path)
+        server.listen(1)
+        server.settimeout(RELAY_TIMEOUT)
+        received = []
+        thread = threading.Thread(target=_stand_in_relay,
+                                  args=(server, received), daemon=True)
+        thread.start()
+        start = time.time()
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', os.path.abspath(__file__),
+             '-c', os.path.join(directory, 'missing.yaml'), '!self-check',
+             'self-check'],
+            env=dict(os.environ, ZABBIX_BOT_RELAY_SOCKET=socket_path),
+            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        elapsed = time.time() - start
+        thread.join(RELAY_TIMEOUT)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            imports.append((int(fields[1]) / 1e6, fields[2][1:].rstrip()))
+
+    # Imports up to site are the interpreter startup.
+    names = [name for _, name in imports]
+    if 'site' in names:
+        imports = imports[len(names) - names[::-1].index('site'):]
+
+    total = sum(seconds for seconds, name in imports
+                if not name.startswith(' '))
+    direct = sorted({name.strip().split('.')[0] for _, name in imports} &
+                    set(DIRECT_IMPORTS))
+    print('import {0:.1f} ms (budget {1:.1f} ms), alert to the relay '
+          '{2:.1f} ms'.format(total * 1000, budget * 1000, elapsed * 1000))
+    for seconds, name in sorted(imports, reverse=True)[:top]:
+        print('{0:>9.1f} ms {1}'.format(seconds * 1000, name))
+
+    if direct:
+        print('the path to the relay imported {0}'.format(', '.join(direct)))
+
+    if not received:
+        print('the alert did not reach the relay')
+
+    return total <= budget and not direct and bool(received)
+
+
+def _stand_in_relay(server, received):
+    """Takes one alert and answers it like alert_relay.py.
+    """
+    try:
+        connection, _ = server.accept()
+        with connection:
+            received.append(connection.makefile('rb').read())
+            connection.sendall(b'ok\n')
+
+    except OSError as error:
+        logging.error('self-check relay: %s', error)
 
 
 if __name__ == '__main__':
+    if '--self-check' in sys.argv[1:]:
+        raise SystemExit(0 if self_check() else 1)
+
     locale.setlocale(locale.LC_CTYPE, 'en_US.UTF-8')
     args = matrix.flags()
     args['message'] = " ".join(args['message'])
@@ -43,8 +263,31 @@ if __name__ == '__main__':
     else:
         matrix.set_log_level()
 
+    alert = {'room': args['room'],
+             'message': args['message'],
+             'message_type': args['message_type']}
+    socket_path = args['socket'] or matrix.RELAY_SOCKET
+    sent = relay(socket_path, alert)
+    file_config = None
+    if not sent and args['socket'] is None:
+        # Reading the config needs yaml, so the socket of its relay
+        # section is only tried when the default socket fails.
+        try:
+            file_config = matrix.read_config(args['config'])
+
+        except FileNotFoundError:
+            file_config = {}
+
+        configured = (file_config.get('relay') or {}).get('socket')
+        if configured and configured != socket_path:
+            sent = relay(configured, alert)
+
+    if sent:
+        raise SystemExit(0)
+
     try:
-        config = matrix.merge_config(args, matrix.read_config(args['config']))
+        config = matrix.merge_config(
+            args, file_config or matrix.read_config(args['config']))
         config['matrix'] = matrix.merge_config(args, config['matrix'])
 
     except FileNotFoundError:
@@ -52,14 +295,9 @@ if __name__ == '__main__':
         if None in [config['username'], config['password'], config['room']]:
             raise
 
-    color_config = {}
-    for key, value in config['colors'].items():
-        if key.startswith('zabbix'):
-            key = key.replace('zabbix_', '')
-            color_config[key] = value
-
-    logging.debug(color_config)
-    config['matrix']['message'] = colorize(color_config, config['message'])
+    colors = color_table(config)
+    logging.debug(colors.colors)
+    config['matrix']['message'] = colorize(colors, config['message'])
     client, room = matrix.setup(config['matrix'])
     matrix.send_message(config['matrix'], room)
     if 'token' not in config['matrix']:
@@ -0,0 +1,142 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Matrix client for the matrix-zabbix-bot that syncs with a
+server-side filter and resumes from the sync token of its previous run, so a
+restart costs a single small /sync instead of an initial sync of every room.
+"""
+import json
+import logging
+import os
+
+from matrix_client.client import MatrixClient
+from matrix_client.errors import MatrixRequestError
+
+# Number of timeline events per room in a sync, as MatrixClient does.
+TIMELINE_LIMIT = 20
+
+
+def sync_filter(rooms=None):
+    """Returns the sync filter for the bot: only m.room.message events in
+    the given rooms, with the room members loaded lazily.
+
+    :param rooms: room ids, None for all rooms
+    :type rooms: list
+    :return: filter definition
+    """
+    room_filter = {
+        'timeline': {'types': ['m.room.message'], 'limit': TIMELINE_LIMIT},
+        'state': {'lazy_load_members': True},
+    }
+    if rooms is not None:
+        room_filter['rooms'] = sorted(rooms)
+
+    return {'room': room_filter}
+
+
+class SyncClient(MatrixClient):
+    """MatrixClient with a server-side sync filter. The next_batch token is
+    written to `state_path` after every sync and used by the first sync of
+    the next run. Events that arrived in between are not handed to the
+    listeners, which are added after that first sync, so commands sent
+    while the bot was down are not replayed.
+    """
+    def __init__(self, *args, state_path=None, rooms=None, **kwargs):
+        """
+        :param state_path: file to keep the sync token in, None to not keep
+                           it
+        :type state_path: str
+        :param rooms: room ids to sync, None for all rooms
+        :type rooms: list
+        """
+        self.state_path = state_path
+        self.filter_rooms = rooms
+        self.state = _load(state_path)
+        self.filter_ready = False
+        self.resumed = False
+        super().__init__(*args, **kwargs)
+
+    def _setup(self):
+        """Picks the filter and the sync token to start from.
+        """
+        definition = sync_filter(self.filter_rooms)
+        same_user = self.state.get('user_id') == self.user_id
+        if (same_user and self.state.get('filter') == definition and
+                self.state.get('filter_id')):
+            self.sync_filter = self.state['filter_id']
+
+        else:
+            try:
+                self.sync_filter = self.api.create_filter(
+                    self.user_id, definition)['filter_id']
+
+            except MatrixRequestError as error:
+                logging.warning('cannot create a sync filter (%s), sending '
+                                'it with every sync', error)
+                self.sync_filter = json.dumps(definition)
+
+        if same_user and self.state.get('next_batch'):
+            logging.info('resuming the Matrix sync from %s',
+                         self.state['next_batch'])
+            self.sync_token = self.state['next_batch']
+            self.resumed = True
+
+        self.state = {'user_id': self.user_id, 'filter': definition,
+                      'filter_id': self.sync_filter}
+        self.filter_ready = True
+
+    def _sync(self, timeout_ms=30000):
+        if not self.filter_ready:
+            self._setup()
+
+        try:
+            super()._sync(timeout_ms)
+
+        except MatrixRequestError as error:
+            if not self.resumed or not 400 <= error.code < 500:
+                raise
+
+            # The saved token or filter is no longer known to the server.
+            logging.warning('cannot resume the Matrix sync (%s), starting '
+                            'over', error)
+            self.state = {}
+            self.sync_token = None
+            self.resumed = False
+            self._setup()
+            super()._sync(timeout_ms)
+
+        self.resumed = False
+        self._save()
+
+    def _save(self):
+        if self.state_path is None:
+            return
+
+        if self.state.get('next_batch') == self.sync_token:
+            return
+
+        self.state['next_batch'] = self.sync_token
+        tmp = self.state_path + '.tmp'
+        try:
+            with open(tmp, 'w') as file_descriptor:
+                json.dump(self.state, file_descriptor)
+
+            os.replace(tmp, self.state_path)
+
+        except OSError as error:
+            logging.warning('cannot save the Matrix sync token to %s: %s',
+                            self.state_path, error)
+
+
+def _load(path):
+    """Reads the saved sync state, an empty dict when there is none.
+    """
+    if path is None or not os.path.isfile(path):
+        return {}
+
+    try:
+        with open(path, 'r') as file_descriptor:
+            return json.load(file_descriptor)
+
+    except ValueError as error:
+        logging.warning('ignoring the Matrix sync state in %s: %s', path,
+                        error)
+        return {}
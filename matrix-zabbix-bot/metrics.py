@@ -0,0 +1,194 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Minimal Prometheus metrics for the matrix-zabbix-bot, served
+as text over a local HTTP endpoint.
+"""
+import contextlib
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency histograms, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Default port of the metrics endpoint.
+PORT = 9310
+
+REGISTRY = []
+
+
+def _labels(labels, extra=None):
+    items = sorted(labels)
+    if extra is not None:
+        items.append(extra)
+
+    if not items:
+        return ''
+
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(key, str(value).replace('\\', '\\\\')
+                           .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in items))
+
+
+class Metric(object):
+    """Base of the metric types, values are kept per label set.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        """Yields (name, labels, extra label, value) tuples.
+        """
+        with self.lock:
+            values = list(self.values.items())
+
+        for labels, value in values:
+            yield self.name, labels, None, value
+
+    def render(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.documentation),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for name, labels, extra, value in self.samples():
+            lines.append('{0}{1} {2}'.format(name, _labels(labels, extra),
+                                             repr(float(value))))
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is read from a function when scraped.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, (), None, self.function()
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(
+                key, ((0,) * len(BUCKETS), 0.0, 0))
+            counts = tuple(bucket + (value <= bound)
+                           for bucket, bound in zip(counts, BUCKETS))
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with block.
+        """
+        start = time.time()
+        try:
+            yield
+
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+
+        for labels, (counts, total, count) in values:
+            for bound, bucket in zip(BUCKETS, counts):
+                yield (self.name + '_bucket', labels, ('le', repr(bound)),
+                       bucket)
+
+            yield self.name + '_bucket', labels, ('le', '+Inf'), count
+            yield self.name + '_sum', labels, None, total
+            yield self.name + '_count', labels, None, count
+
+
+ZABBIX_REQUESTS = Histogram(
+    'zabbix_api_request_seconds', 'Duration of Zabbix API calls.')
+ZABBIX_ERRORS = Counter(
+    'zabbix_api_errors_total', 'Zabbix API calls that failed.')
+ZABBIX_LOGINS = Counter(
+    'zabbix_api_logins_total', 'Logins to the Zabbix API.')
+COMMANDS = Histogram(
+    'zabbix_bot_command_seconds',
+    'Time from receiving a command until its reply is queued.')
+MATRIX_SENDS = Histogram(
+    'matrix_send_seconds', 'Duration of sending a message to Matrix.')
+MATRIX_FAILURES = Counter(
+    'matrix_send_failures_total', 'Messages that failed to send to Matrix.')
+QUEUE_LATENCY = Histogram(
+    'matrix_send_queue_seconds',
+    'Time from queueing a message in the outbox until it is sent.')
+QUEUE_RETRIES = Counter(
+    'matrix_send_queue_retries_total', 'Sends retried by the outbox.')
+QUEUE_DROPPED = Counter(
+    'matrix_send_queue_dropped_total',
+    'Messages dropped by the outbox after being refused.')
+SYNC_RESTARTS = Counter(
+    'zabbix_bot_sync_restarts_total', 'Restarts of the Matrix sync loop.')
+WATCH_EVENTS = Counter(
+    'zabbix_bot_watch_events_total',
+    'New trigger events found for watching rooms, per realm.')
+CACHE = Counter(
+    'zabbix_bot_cache_requests_total',
+    'Snapshot cache lookups by result (hit, miss or shared).')
+
+
+def render():
+    """Returns all metrics in the Prometheus text format.
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug('metrics: ' + format, *args)
+
+
+def serve(address='127.0.0.1', port=PORT):
+    """Serves the metrics from a background thread.
+
+    :param address: address to listen on
+    :type address: str
+    :param port: port to listen on
+    :type port: int
+    :return: the HTTP server
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics',
+                              daemon=True)
+    thread.start()
+    logging.info('serving metrics on http://%s:%d/metrics', address, port)
+    return server
@@ -0,0 +1,117 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Splits long replies of the matrix-zabbix-bot into pages that
+fit in a Matrix event. Pages are produced lazily, the remaining pages of a
+reply are kept per room for `!zabbix more`.
+"""
+import threading
+
+# Maximum size of a page in bytes. A Matrix event is limited to 64 KiB and
+# carries the message twice (html and plain text).
+PAGE_SIZE = 16384
+
+SEPARATOR = '<br />'
+
+
+def paginate(lines, page_size=PAGE_SIZE, separator=SEPARATOR):
+    """Joins lines into pages of at most page_size bytes. A single line
+    longer than a page gets a page of its own.
+
+    :param lines: the lines
+    :type lines: iterable
+    :param page_size: maximum size of a page in bytes
+    :type page_size: int
+    :param separator: joins the lines of a page
+    :type separator: str
+    :return: generator of (page, more) tuples, more tells whether another
+             page follows
+    """
+    page = []
+    size = 0
+    for line in lines:
+        length = len(line.encode('utf-8')) + len(separator)
+        if page and size + length > page_size:
+            yield separator.join(page), True
+            page = []
+            size = 0
+
+        page.append(line)
+        size += length
+
+    yield separator.join(page), False
+
+
+class Pager(object):
+    """Hands out the pages of one reply, one at a time.
+    """
+    def __init__(self, pages):
+        """
+        :param pages: generator as returned by paginate
+        :type pages: generator
+        """
+        self.pages = pages
+        self.lock = threading.Lock()
+        self.done = False
+
+    def next(self):
+        """Returns the next page and whether more pages follow.
+
+        :return: (page, more)
+        """
+        with self.lock:
+            if self.done:
+                return '', False
+
+            page, more = next(self.pages, ('', False))
+            self.done = not more
+            return page, more
+
+
+class Pagers(object):
+    """The pager of the last reply per room.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pagers = {}
+
+    def start(self, room_id, lines, page_size=PAGE_SIZE):
+        """Starts a new paged reply for the room and returns its first page.
+
+        :param room_id: the Matrix room id
+        :type room_id: str
+        :param lines: the lines of the reply
+        :type lines: iterable
+        :param page_size: maximum size of a page in bytes
+        :type page_size: int
+        :return: (page, more)
+        """
+        pager = Pager(paginate(lines, page_size))
+        page, more = pager.next()
+        with self.lock:
+            if more:
+                self.pagers[room_id] = pager
+
+            else:
+                self.pagers.pop(room_id, None)
+
+        return page, more
+
+    def more(self, room_id):
+        """Returns the next page of the last reply in the room.
+
+        :param room_id: the Matrix room id
+        :type room_id: str
+        :return: (page, more)
+        """
+        with self.lock:
+            pager = self.pagers.get(room_id)
+
+        if pager is None:
+            return '', False
+
+        page, more = pager.next()
+        if not more:
+            with self.lock:
+                if self.pagers.get(room_id) is pager:
+                    del self.pagers[room_id]
+
+        return page, more
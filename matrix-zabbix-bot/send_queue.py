@@ -0,0 +1,312 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Outbound message queue for Matrix. Messages are sent in order
+per room and retried with backoff, honouring the homeserver's retry_after_ms.
+Optionally every message is written to an append-only spool file first, so
+unsent messages survive a restart. The spool is rewritten with only the
+unsent messages at startup and every COMPACT_AFTER sent messages.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+from matrix_client.errors import MatrixRequestError
+
+import metrics
+
+# Backoff of the first retry in seconds, doubled per attempt up to MAX_BACKOFF.
+BACKOFF = 1
+MAX_BACKOFF = 300
+
+# Messages the homeserver refuses (4xx other than 429) are dropped after this
+# many attempts, other failures are retried until they succeed.
+MAX_ATTEMPTS = 5
+
+# Sent or dropped messages after which the spool file is compacted.
+COMPACT_AFTER = 1000
+
+# Seconds between logging the stats of the queue while it is busy.
+STATS_INTERVAL = 300
+
+
+class Message(object):
+    """A queued message.
+    """
+    def __init__(self, msgid, room, message, message_type, queued=None,
+                 sent=None):
+        self.msgid = msgid
+        self.room = room
+        self.message = message
+        self.message_type = message_type
+        self.queued = queued or time.time()
+        self.sent = sent
+        self.attempts = 0
+
+    def record(self):
+        return {'op': 'put', 'id': self.msgid, 'room': self.room,
+                'message': self.message, 'type': self.message_type,
+                'queued': self.queued}
+
+
+class SendQueue(threading.Thread):
+    """Sends queued messages with `send(room, message, message_type)` from a
+    background thread. A room waiting for a retry does not hold up the
+    other rooms.
+    """
+    def __init__(self, send, spool=None):
+        """
+        :param send: function doing the actual send
+        :type send: callable
+        :param spool: path of the spool file, None to keep messages in memory
+        :type spool: str
+        """
+        super().__init__(name='send-queue', daemon=True)
+        self.send = send
+        self.spool = spool
+        self.condition = threading.Condition()
+        self.rooms = collections.OrderedDict()
+        self.not_before = {}
+        self.next_id = 1
+        self.sent = 0
+        self.dropped = 0
+        self.retries = 0
+        self.latency = 0.0
+        self.send_time = 0.0
+        self.spool_file = None
+        self.spool_done = 0
+        self.reported = time.time()
+        if spool is not None:
+            self._load_spool()
+
+    def put(self, room, message, message_type=None, sent=None):
+        """Queues a message for a room.
+
+        :param room: room the message is for, as understood by send
+        :type room: str
+        :param message: the html message
+        :type message: str
+        :param message_type: the message type
+        :type message_type: str
+        :param sent: called with the send duration once the message is
+                     sent, it is not kept in the spool
+        :type sent: callable
+        """
+        with self.condition:
+            item = Message(self.next_id, room, message, message_type,
+                           sent=sent)
+            self.next_id += 1
+            self._spool(item.record())
+            self.rooms.setdefault(room, collections.deque()).append(item)
+            self.condition.notify()
+
+    def depth(self):
+        """Returns the number of unsent messages.
+        """
+        with self.condition:
+            return sum(len(queue) for queue in self.rooms.values())
+
+    def stats(self):
+        """Returns the counters of the queue.
+
+        :return: dict with depth, sent, dropped, retries and the average
+                 queue latency and send duration in seconds
+        """
+        depth = self.depth()
+        return {'depth': depth,
+                'sent': self.sent,
+                'dropped': self.dropped,
+                'retries': self.retries,
+                'latency': self.latency / self.sent if self.sent else 0.0,
+                'send_time': (self.send_time / self.sent
+                              if self.sent else 0.0)}
+
+    def run(self):
+        while True:
+            item = self._next()
+            start = time.time()
+            try:
+                self.send(item.room, item.message, item.message_type)
+
+            except Exception as error:
+                self._failed(item, error)
+                self._report()
+                continue
+
+            now = time.time()
+            with self.condition:
+                self.rooms[item.room].popleft()
+                if not self.rooms[item.room]:
+                    del self.rooms[item.room]
+
+                self.sent += 1
+                self.send_time += now - start
+                self.latency += now - item.queued
+                self._spool({'op': 'done', 'id': item.msgid})
+
+            metrics.QUEUE_LATENCY.observe(now - item.queued)
+            logging.debug('sent message %d to %s in %.3fs (queued %.3fs)',
+                          item.msgid, item.room, now - start,
+                          now - item.queued)
+            self._report()
+            if item.sent is not None:
+                try:
+                    item.sent(now - start)
+
+                except Exception as error:  # Keep running!
+                    logging.error(error, exc_info=True)
+
+    def _next(self):
+        """Waits for the first room with a message that may be sent.
+        """
+        with self.condition:
+            while True:
+                now = time.time()
+                wait = None
+                for room, queue in self.rooms.items():
+                    not_before = self.not_before.get(room, 0)
+                    if not_before <= now:
+                        # Rotate the rooms, so a busy room can't starve
+                        # the others.
+                        self.rooms.move_to_end(room)
+                        return queue[0]
+
+                    if wait is None or not_before - now < wait:
+                        wait = not_before - now
+
+                self.condition.wait(wait)
+
+    def _failed(self, item, error):
+        """Schedules the retry of a message, or drops it.
+        """
+        item.attempts += 1
+        delay = min(BACKOFF * 2 ** (item.attempts - 1), MAX_BACKOFF)
+        permanent = False
+        if isinstance(error, MatrixRequestError):
+            if error.code == 429:
+                delay = _retry_after(error, delay)
+
+            elif 400 <= error.code < 500:
+                permanent = True
+
+        with self.condition:
+            if permanent and item.attempts >= MAX_ATTEMPTS:
+                logging.error('dropping message %d to %s after %d attempts: '
+                              '%s', item.msgid, item.room, item.attempts,
+                              error)
+                self.rooms[item.room].popleft()
+                if not self.rooms[item.room]:
+                    del self.rooms[item.room]
+
+                self.dropped += 1
+                metrics.QUEUE_DROPPED.inc()
+                self._spool({'op': 'done', 'id': item.msgid})
+                return
+
+            logging.warning('sending message %d to %s failed (%s), retrying '
+                            'in %.1fs', item.msgid, item.room, error, delay)
+            self.retries += 1
+            metrics.QUEUE_RETRIES.inc()
+            self.not_before[item.room] = time.time() + delay
+
+    def _report(self):
+        """Logs the stats every STATS_INTERVAL seconds while messages are
+        being sent.
+        """
+        now = time.time()
+        if now - self.reported < STATS_INTERVAL:
+            return
+
+        self.reported = now
+        logging.info('send queue: %(depth)d waiting, %(sent)d sent, '
+                     '%(dropped)d dropped, %(retries)d retries, average '
+                     'latency %(latency).3fs, average send %(send_time).3fs',
+                     self.stats())
+
+    def _spool(self, record):
+        """Appends a record to the spool file. Called with the condition
+        held.
+        """
+        if self.spool_file is None:
+            return
+
+        self.spool_file.write(json.dumps(record) + '\n')
+        self.spool_file.flush()
+        if record['op'] == 'done':
+            self.spool_done += 1
+            if self.spool_done >= COMPACT_AFTER:
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the spool file with only the unsent messages. Called
+        with the condition held, once the sent message is off its queue.
+        """
+        self.spool_done = 0
+        tmp = self.spool + '.tmp'
+        try:
+            with open(tmp, 'w') as file_descriptor:
+                for queue in self.rooms.values():
+                    for item in queue:
+                        file_descriptor.write(json.dumps(item.record()) +
+                                              '\n')
+
+            os.replace(tmp, self.spool)
+            spool_file = open(self.spool, 'a')
+
+        except OSError as error:
+            logging.warning('cannot compact the spool %s: %s', self.spool,
+                            error)
+            return
+
+        self.spool_file.close()
+        self.spool_file = spool_file
+        logging.debug('compacted the spool %s', self.spool)
+
+    def _load_spool(self):
+        """Queues the unsent messages of the spool file and rewrites it with
+        only those messages.
+        """
+        pending = collections.OrderedDict()
+        if os.path.isfile(self.spool):
+            with open(self.spool, 'r') as file_descriptor:
+                for line in file_descriptor:
+                    try:
+                        record = json.loads(line)
+
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue
+
+                    if record['op'] == 'put':
+                        pending[record['id']] = record
+
+                    else:
+                        pending.pop(record['id'], None)
+
+        tmp = self.spool + '.tmp'
+        with open(tmp, 'w') as file_descriptor:
+            for record in pending.values():
+                item = Message(self.next_id, record['room'],
+                               record['message'], record['type'],
+                               record['queued'])
+                self.next_id += 1
+                file_descriptor.write(json.dumps(item.record()) + '\n')
+                self.rooms.setdefault(item.room,
+                                      collections.deque()).append(item)
+
+        os.replace(tmp, self.spool)
+        self.spool_file = open(self.spool, 'a')
+        if pending:
+            logging.info('requeued %d unsent messages from %s',
+                         len(pending), self.spool)
+
+
+def _retry_after(error, default):
+    """Returns the retry_after_ms of an M_LIMIT_EXCEEDED error in seconds.
+    """
+    try:
+        return json.loads(error.content)['retry_after_ms'] / 1000
+
+    except (ValueError, KeyError, TypeError):
+        return default
@@ -0,0 +1,168 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Background trigger synchronizer for the matrix-zabbix-bot.
+Keeps an in-memory trigger table per realm up to date by fetching only the
+triggers that changed since the last poll.
+"""
+import logging
+import threading
+import time
+
+# Seconds between full resyncs, these pick up deleted or disabled triggers
+# and refresh the item values.
+RESYNC_INTERVAL = 300
+
+# Zabbix keeps returning recovered triggers for `only_true` during this many
+# seconds (ZBX_OK_PERIOD), older recovered triggers are dropped locally.
+OK_PERIOD = 1800
+
+
+class TriggerSync(threading.Thread):
+    """Polls trigger.get with lastChangeSince and applies the deltas to a
+    local trigger table.
+    """
+    def __init__(self, zapi, params, interval, resync=RESYNC_INTERVAL):
+        """
+        :param zapi: reference to the Zabbix session
+        :type zapi: zabbix.Session
+        :param params: trigger.get parameters of a full fetch
+        :type params: dict
+        :param interval: seconds between polls
+        :type interval: int
+        :param resync: seconds between full fetches
+        :type resync: int
+        """
+        super().__init__(name='trigger-sync', daemon=True)
+        self.zapi = zapi
+        self.params = params
+        self.interval = interval
+        self.resync = resync
+        self.lock = threading.Lock()
+        self.table = {}
+        self.cursor = None
+        self.updated = None
+        self.last_full = None
+        self.stopped = threading.Event()
+
+    def full_sync(self):
+        """Replaces the trigger table with a full fetch.
+        """
+        triggers = self.zapi.trigger.get(**self.params)
+        table = {trigger['triggerid']: trigger for trigger in triggers}
+        with self.lock:
+            self.table = table
+            self.cursor = self._cursor(triggers, self.cursor)
+            self.updated = self.last_full = time.time()
+
+        logging.debug('full trigger sync: %d triggers', len(table))
+
+    def delta_sync(self):
+        """Fetches the triggers that changed since the cursor, and the
+        acknowledge state of the current problems.
+        """
+        # lastChangeSince is exclusive, overlap a second to not miss changes
+        # that happened in the same second as the previous poll.
+        params = dict(self.params, lastChangeSince=self.cursor - 1)
+        changed = self.zapi.trigger.get(**params)
+        params = {key: value for key, value in self.params.items()
+                  if not key.startswith('select') and
+                  key != 'expandDescription'}
+        params.update(output=['triggerid'], withLastEventUnacknowledged=1)
+        unacked = self.zapi.trigger.get(**params)
+        unacked = {trigger['triggerid'] for trigger in unacked}
+        expired = time.time() - OK_PERIOD
+        with self.lock:
+            table = dict(self.table)
+            for trigger in changed:
+                table[trigger['triggerid']] = trigger
+
+            for triggerid, trigger in list(table.items()):
+                if (trigger['value'] == '0' and
+                        int(trigger['lastchange']) < expired):
+                    del table[triggerid]
+
+                elif trigger.get('lastEvent'):
+                    acknowledged = '0' if triggerid in unacked else '1'
+                    last_event = trigger['lastEvent']
+                    if last_event.get('acknowledged') != acknowledged:
+                        table[triggerid] = self._with_ack(trigger,
+                                                          acknowledged)
+
+            self.table = table
+            self.cursor = self._cursor(changed, self.cursor)
+            self.updated = time.time()
+
+        logging.debug('delta trigger sync: %d changed, %d triggers',
+                      len(changed), len(table))
+
+    def acknowledged(self, triggerids):
+        """Marks the last events of the triggers as acknowledged, so an ack
+        by the bot shows before the next poll.
+
+        :param triggerids: ids of the acknowledged triggers
+        :type triggerids: list
+        """
+        with self.lock:
+            table = dict(self.table)
+            for triggerid in triggerids:
+                trigger = table.get(triggerid)
+                if trigger is not None and trigger.get('lastEvent'):
+                    table[triggerid] = self._with_ack(trigger, '1')
+
+            self.table = table
+
+    def triggers(self):
+        """Returns the synchronized triggers, or None when the table is not
+        (or no longer) up to date.
+
+        :return: list of raw triggers or None
+        """
+        with self.lock:
+            if (self.updated is None or
+                    time.time() - self.updated > 3 * self.interval):
+                return None
+
+            return list(self.table.values())
+
+    def stop(self):
+        """Stops the polling, the table is no longer handed out.
+        """
+        self.stopped.set()
+        with self.lock:
+            self.updated = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if (self.last_full is None or
+                        time.time() - self.last_full > self.resync):
+                    self.full_sync()
+
+                else:
+                    self.delta_sync()
+
+            except Exception as error:  # Keep running!
+                logging.error('trigger sync failed: %s', error, exc_info=True)
+
+            self.stopped.wait(self.interval)
+
+    @staticmethod
+    def _cursor(triggers, cursor):
+        """Returns the new lastchange cursor.
+        """
+        clocks = [int(trigger['lastchange']) for trigger in triggers]
+        if cursor is not None:
+            clocks.append(cursor)
+
+        if not clocks:
+            return int(time.time())
+
+        return max(clocks)
+
+    @staticmethod
+    def _with_ack(trigger, acknowledged):
+        """Returns a copy of the trigger with the acknowledge state of its
+        last event replaced. Triggers are never changed in place, snapshots
+        handed out by triggers() stay consistent.
+        """
+        last_event = dict(trigger['lastEvent'], acknowledged=acknowledged)
+        return dict(trigger, lastEvent=last_event)
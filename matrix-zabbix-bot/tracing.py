@@ -0,0 +1,197 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Per-command timing traces for the matrix-zabbix-bot. A trace
+is bound to the thread running the command, code on the way records spans
+with `with tracing.span(name):`, which does next to nothing when no trace is
+active.
+
+Tracing is enabled for all commands with the ZABBIX_BOT_TRACE environment
+variable or the --trace flag of zabbix_bot.py, and for a single command with
+a trailing --trace.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('ZABBIX_BOT_TRACE', '') not in ('', '0')
+
+_local = threading.local()
+
+
+class _NoSpan(object):
+    """Stands in for a span when no trace is active. It is falsy, so
+    expensive span fields can be skipped with `if span:`.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def __bool__(self):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class Span(object):
+    """A timed part of a command, fields are added to the trace output.
+    """
+    def __init__(self, trace, name, fields):
+        self.trace = trace
+        self.name = name
+        self.fields = fields
+        self.start = None
+        self.children = 0.0
+
+    def __enter__(self):
+        self.start = time.time()
+        self.trace.stack.append(self)
+        return self
+
+    def __exit__(self, *_):
+        duration = time.time() - self.start
+        self.trace.stack.pop()
+        if self.trace.stack:
+            self.trace.stack[-1].children += duration
+
+        self.trace.add(self.name, duration, self.children, **self.fields)
+        return False
+
+
+class Trace(object):
+    """The spans of one command.
+    """
+    def __init__(self, command, room_id, reply=False, parent=None,
+                 fields=None):
+        """
+        :param command: the command, e.g. 'unacked'
+        :type command: str
+        :param room_id: the Matrix room id
+        :type room_id: str
+        :param reply: append the trace to the reply
+        :type reply: bool
+        :param parent: trace the spans are added to instead, see fork
+        :type parent: Trace
+        :param fields: fields added to every span
+        :type fields: dict
+        """
+        self.command = command
+        self.room_id = room_id
+        self.reply = reply
+        self.parent = parent
+        self.fields = fields or {}
+        self.start = time.time()
+        # Set when the command is handed to the worker pool.
+        self.queued = None
+        self.spans = []
+        self.stack = []
+
+    def add(self, name, duration, children=0.0, **fields):
+        """Records a span that was timed elsewhere.
+
+        :param name: name of the span
+        :type name: str
+        :param duration: duration in seconds
+        :type duration: float
+        :param children: time spent in nested spans
+        :type children: float
+        """
+        if self.parent is not None:
+            return self.parent.add(name, duration, children,
+                                   **dict(fields, **self.fields))
+
+        span = dict(fields, name=name, ms=round(duration * 1000, 3))
+        if children:
+            span['self_ms'] = round((duration - children) * 1000, 3)
+
+        self.spans.append(span)
+
+    def fork(self, **fields):
+        """Returns a trace for part of the command that runs in another
+        thread. Its spans end up in this trace, with the fields added.
+        """
+        return Trace(self.command, self.room_id, parent=self, fields=fields)
+
+    def span(self, name, **fields):
+        """Returns a span of this trace, also when it is not active.
+        """
+        return Span(self, name, fields)
+
+    def summary(self):
+        """Returns the trace as one line of html for the reply.
+        """
+        parts = []
+        for span in self.spans:
+            extra = ', '.join('{0}={1}'.format(key, value)
+                              for key, value in span.items()
+                              if key not in ('name', 'ms', 'self_ms'))
+            if 'self_ms' in span:
+                extra = ', '.join(filter(None, [
+                    'self {0:.1f} ms'.format(span['self_ms']), extra]))
+
+            parts.append('{0} {1:.1f} ms{2}'.format(
+                span['name'], span['ms'],
+                ' ({0})'.format(extra) if extra else ''))
+
+        parts.append('total {0:.1f} ms'.format(
+            (time.time() - self.start) * 1000))
+        return 'Trace: ' + ', '.join(parts)
+
+    def log(self):
+        """Logs the trace as one JSON line.
+        """
+        logging.info('trace %s', json.dumps({
+            'command': self.command,
+            'room': self.room_id,
+            'total_ms': round((time.time() - self.start) * 1000, 3),
+            'spans': self.spans}))
+
+    def sent(self, duration):
+        """Records the Matrix send and logs the trace, for
+        send_queue.SendQueue.put.
+
+        :param duration: duration of the send in seconds
+        :type duration: float
+        """
+        self.add('matrix.send', duration)
+        self.log()
+
+
+class activate(object):
+    """Binds a trace to the current thread for the duration of the with
+    block. A trace of None is allowed and does nothing.
+    """
+    def __init__(self, trace):
+        self.trace = trace
+
+    def __enter__(self):
+        self.previous = getattr(_local, 'trace', None)
+        _local.trace = self.trace
+        return self.trace
+
+    def __exit__(self, *_):
+        _local.trace = self.previous
+        return False
+
+
+def current():
+    """Returns the trace bound to the current thread, or None.
+    """
+    return getattr(_local, 'trace', None)
+
+
+def span(name, **fields):
+    """Returns a span of the active trace, or NO_SPAN without one.
+
+    :param name: name of the span, e.g. 'zabbix.api'
+    :type name: str
+    :return: Span or NO_SPAN
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return NO_SPAN
+
+    return Span(trace, name, fields)
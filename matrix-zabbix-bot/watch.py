@@ -0,0 +1,252 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Watch mode for the matrix-zabbix-bot. Rooms subscribe to the
+problems of their realms, one poller per realm follows the new events with
+an event.get cursor and pushes them to every subscribed room.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+import metrics
+import zabbix
+
+# Seconds between event polls of a realm.
+INTERVAL = 30
+
+
+class Subscriptions(object):
+    """The realms each room watches with their minimal priority, kept in a
+    JSON file so they survive a restart.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: file to keep the subscriptions in, None to keep them in
+                     memory
+        :type path: str
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.rooms = _load(path)
+
+    def subscribe(self, room_id, realms, level):
+        """Watches the realms for the room, replacing the level of realms it
+        already watches.
+
+        :param room_id: the Matrix room id
+        :type room_id: str
+        :param realms: the realms to watch
+        :type realms: tuple
+        :param level: minimal priority of the events
+        :type level: int
+        """
+        with self.lock:
+            watched = self.rooms.setdefault(room_id, {})
+            watched.update(dict.fromkeys(realms, level))
+            self._save()
+
+    def unsubscribe(self, room_id, realms):
+        """Stops watching the realms for the room.
+
+        :return: the realms that were watched
+        """
+        with self.lock:
+            watched = self.rooms.get(room_id, {})
+            stopped = [realm for realm in realms if realm in watched]
+            for realm in stopped:
+                del watched[realm]
+
+            if not watched:
+                self.rooms.pop(room_id, None)
+
+            self._save()
+
+        return stopped
+
+    def watched(self, room_id):
+        """Returns {realm: level} of the room.
+        """
+        with self.lock:
+            return dict(self.rooms.get(room_id, {}))
+
+    def realms(self):
+        """Returns the realms watched by any room.
+        """
+        with self.lock:
+            return {realm for watched in self.rooms.values()
+                    for realm in watched}
+
+    def rooms_of(self, realm):
+        """Returns {room_id: level} of the rooms watching the realm.
+        """
+        with self.lock:
+            return {room_id: watched[realm]
+                    for room_id, watched in self.rooms.items()
+                    if realm in watched}
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as file_descriptor:
+                json.dump(self.rooms, file_descriptor)
+
+            os.replace(tmp, self.path)
+
+        except OSError as error:
+            logging.warning('cannot save the watch subscriptions to %s: %s',
+                            self.path, error)
+
+
+class EventPoller(threading.Thread):
+    """Follows the events of one realm for all rooms watching it. Only the
+    events after the cursor are fetched, a poll without news is a single
+    small event.get.
+    """
+    def __init__(self, realm, subscriptions, configs, deliver,
+                 interval=INTERVAL):
+        """
+        :param realm: the realm to follow
+        :type realm: str
+        :param subscriptions: the rooms and their levels
+        :type subscriptions: Subscriptions
+        :param configs: returns the current zabbix configuration per realm
+        :type configs: callable
+        :param deliver: called with (realm, room_id, events) for every room
+                        with new events, events as returned by
+                        zabbix.event_info
+        :type deliver: callable
+        :param interval: seconds between polls
+        :type interval: int
+        """
+        super().__init__(name='watch-{0}'.format(realm), daemon=True)
+        self.realm = realm
+        self.subscriptions = subscriptions
+        self.configs = configs
+        self.deliver = deliver
+        self.interval = interval
+        self.cursor = None
+
+    def poll(self):
+        """Fetches the events after the cursor and hands them to the rooms.
+        Without watching rooms the cursor is dropped, so the events in
+        between are not pushed once a room watches again.
+        """
+        rooms = self.subscriptions.rooms_of(self.realm)
+        config = self.configs().get(self.realm)
+        if not rooms or config is None:
+            self.cursor = None
+            return
+
+        if self.cursor is None:
+            self.cursor = zabbix.event_cursor(config)
+            logging.debug('watching %s from event %d', self.realm,
+                          self.cursor['eventid'])
+            return
+
+        events = []
+        try:
+            events.extend(zabbix.iter_events(config, self.cursor))
+
+        finally:
+            # Events before a failed page are not fetched again.
+            self._push(rooms, events)
+
+    def _push(self, rooms, events):
+        if not events:
+            return
+
+        logging.debug('%d new events in %s', len(events), self.realm)
+        metrics.WATCH_EVENTS.inc(len(events), realm=self.realm)
+        for room_id, level in rooms.items():
+            selected = [event for event in events if event['level'] >= level]
+            if selected:
+                self.deliver(self.realm, room_id, selected)
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+
+            except Exception as error:  # Keep running!
+                logging.error('watching %s failed: %s', self.realm, error,
+                              exc_info=True)
+
+            time.sleep(self.interval)
+
+
+class Watches(object):
+    """The subscriptions and a poller for every watched realm.
+    """
+    def __init__(self, configs, deliver, path=None, interval=INTERVAL):
+        """
+        :param configs: returns the current zabbix configuration per realm
+        :type configs: callable
+        :param deliver: see EventPoller
+        :type deliver: callable
+        :param path: file to keep the subscriptions in
+        :type path: str
+        :param interval: seconds between polls of a realm
+        :type interval: int
+        """
+        self.subscriptions = Subscriptions(path)
+        self.configs = configs
+        self.deliver = deliver
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pollers = {}
+
+    def start(self):
+        """Starts the pollers of the realms watched before a restart.
+        """
+        for realm in self.subscriptions.realms():
+            self._poller(realm)
+
+    def watch(self, room_id, realms, level):
+        """Subscribes the room to the realms.
+        """
+        self.subscriptions.subscribe(room_id, realms, level)
+        for realm in realms:
+            self._poller(realm)
+
+    def unwatch(self, room_id, realms):
+        """Unsubscribes the room from the realms, a poller without rooms
+        idles.
+
+        :return: the realms that were watched
+        """
+        return self.subscriptions.unsubscribe(room_id, realms)
+
+    def watched(self, room_id):
+        """Returns {realm: level} of the room.
+        """
+        return self.subscriptions.watched(room_id)
+
+    def _poller(self, realm):
+        with self.lock:
+            if realm not in self.pollers:
+                poller = EventPoller(realm, self.subscriptions, self.configs,
+                                     self.deliver, self.interval)
+                poller.start()
+                self.pollers[realm] = poller
+
+
+def _load(path):
+    """Reads the saved subscriptions, an empty dict when there are none.
+    """
+    if path is None or not os.path.isfile(path):
+        return collections.OrderedDict()
+
+    try:
+        with open(path, 'r') as file_descriptor:
+            return json.load(file_descriptor,
+                             object_pairs_hook=collections.OrderedDict)
+
+    except ValueError as error:
+        logging.warning('ignoring the watch subscriptions in %s: %s', path,
+                        error)
+        return collections.OrderedDict()
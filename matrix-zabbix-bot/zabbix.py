@@ -4,11 +4,19 @@ Description:    Wrapper around pyzabbix for use in the matrix-zabbix-bot.
 """
 import argparse
 import configparser
+import json
 import logging
 import os
 import pprint
+import operator
 import re
+import threading
+import time
 from pyzabbix import ZabbixAPI, ZabbixAPIException
+from cache import SnapshotCache
+import metrics
+import sync
+import tracing
 from matrix import set_log_level
 
 PRIORITY = {
@@ -20,6 +28,96 @@ PRIORITY = {
     5: 'Disaster',
 }
 
+# Zabbix answers with one of these when the auth token is no longer valid.
+SESSION_EXPIRED = re.compile('re-login|not authori[sz]ed', re.IGNORECASE)
+
+# Fetches the hosts and items along with the triggers, this saves an
+# item.get and host.get per trigger in trigger_info.
+TRIGGER_SELECT = {
+    'selectHosts': ['hostid', 'name'],
+    'selectItems': ['itemid', 'hostid', 'prevvalue'],
+}
+
+# Triggers that are, or recently were, in a problem state together with the
+# acknowledge state of their last event.
+PROBLEM_TRIGGERS = dict(
+    only_true=1,
+    skipDependent=1,
+    monitored=1,
+    active=1,
+    output='extend',
+    expandDescription=1,
+    selectLastEvent=['eventid', 'acknowledged'],
+    **TRIGGER_SELECT)
+
+# Resolves the last events of triggers to acknowledge, and the
+# event.acknowledge parameters.
+ACK_TRIGGERS = {
+    'output': ['triggerid', 'value'],
+    'selectLastEvent': ['eventid', 'acknowledged'],
+}
+ACK_PARAMS = {
+    'action': 2,
+    'message': 'Acknowledged by the Matrix-Zabbix bot',
+}
+
+# Selectors of trigger commands, e.g. host=web* or severity<=warning.
+SELECTOR = re.compile(r'^(\w+)(<=|>=|=|<|>)(.+)$')
+SEVERITY_OPERATORS = {
+    '=': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+# Seconds before the hostgroup index is downloaded again. On a miss the index
+# is refreshed, but not more often than HOSTGROUP_MISS_INTERVAL.
+HOSTGROUP_TTL = 300
+HOSTGROUP_MISS_INTERVAL = 30
+
+HOSTGROUP_GET = {
+    'monitored_hosts': True,
+    'output': ['groupid', 'name'],
+}
+
+# Seconds the trigger snapshot of a realm is shared between commands.
+CACHE_TTL = 10
+
+# Marks a host - key combination without a value in an item value table.
+MISSING = None
+
+# Problem and recovery events of triggers, oldest first, for watching a
+# realm. The trigger comes along for its priority and description.
+WATCH_EVENTS = {
+    'source': 0,
+    'object': 0,
+    'output': ['eventid', 'clock', 'value', 'name', 'objectid'],
+    'selectHosts': ['name'],
+    'selectRelatedObject': ['triggerid', 'priority', 'description'],
+    'sortfield': ['eventid'],
+    'sortorder': 'ASC',
+}
+
+# Events fetched per event.get call while watching.
+WATCH_PAGE = 500
+
+# Value types of numeric items, float and unsigned, the only ones with
+# trends.
+NUMERIC = ('0', '3')
+
+# Values fetched per history.get call, and hours per trend.get call.
+HISTORY_PAGE = 10000
+TREND_PAGE = 1000
+
+# Windows longer than this many seconds are read from the hourly trends
+# instead of the history.
+TREND_WINDOW = 7 * 86400
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_session_locks = {}
+
 
 def flags():
     parser = argparse.ArgumentParser(description=('Python wrapper around '
@@ -65,34 +163,322 @@ def read_config(config_file, section):
     return {key: value for key, value in config[section].items()}
 
 
+class Session(object):
+    """Long-lived ZabbixAPI session. The auth token and the underlying HTTP
+    connection are reused for every call, a new login is only done when
+    Zabbix reports the session as expired.
+
+    Attribute access mirrors ZabbixAPI, e.g. `session.trigger.get(...)`.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.zapi = ZabbixAPI(config['host'], timeout=config.get('timeout'))
+        self.lock = threading.Lock()
+        self.hostgroup_index = HostgroupIndex(
+            self, config.get('hostgroup_ttl', HOSTGROUP_TTL))
+        self.snapshots = SnapshotCache(config.get('cache_ttl', CACHE_TTL))
+        self.sync = None
+        self.login()
+        self.configure(config)
+
+    def configure(self, config):
+        """Applies the settings of a (reloaded) config to the session: the
+        request timeout, the cache ttls and the trigger synchronizer, which
+        is started, stopped or given its new intervals.
+
+        :param config: config of the realm, as returned by read_config
+        :type config: dict
+        """
+        self.config = config
+        self.zapi.timeout = config.get('timeout')
+        self.hostgroup_index.ttl = config.get('hostgroup_ttl', HOSTGROUP_TTL)
+        self.snapshots.ttl = config.get('cache_ttl', CACHE_TTL)
+        interval = config.get('sync_interval')
+        resync = int(config.get('sync_resync', sync.RESYNC_INTERVAL))
+        if not interval:
+            if self.sync is not None:
+                self.sync.stop()
+                self.sync = None
+
+        elif self.sync is None:
+            self.sync = sync.TriggerSync(self, PROBLEM_TRIGGERS,
+                                         int(interval), resync)
+            self.sync.start()
+
+        else:
+            self.sync.interval = int(interval)
+            self.sync.resync = resync
+
+    def close(self):
+        """Stops the trigger synchronizer and closes the HTTP connections.
+        """
+        if self.sync is not None:
+            self.sync.stop()
+            self.sync = None
+
+        self.zapi.session.close()
+
+    def login(self):
+        """Logs in to Zabbix and stores the auth token.
+        """
+        with self.lock:
+            logging.debug('logging in to %s', self.config['host'])
+            metrics.ZABBIX_LOGINS.inc()
+            with tracing.span('zabbix.login'):
+                self.zapi.login(self.config['username'],
+                                self.config['password'])
+
+    def do_request(self, method, params=None):
+        """Performs a request, logging in again when the session expired.
+
+        :param method: Zabbix API method, e.g. 'trigger.get'
+        :type method: str
+        :param params: parameters for the method
+        :type params: dict or list
+        :return: JSON-RPC response
+        """
+        auth = self.zapi.auth
+        try:
+            return self._request(method, params)
+
+        except ZabbixAPIException as error:
+            if SESSION_EXPIRED.search(str(error)) is None:
+                raise
+
+            logging.info('Zabbix session for %s expired, logging in again',
+                         self.config['host'])
+            if self.zapi.auth == auth:
+                self.login()
+
+            return self._request(method, params)
+
+    def _request(self, method, params):
+        """Performs a single request, recording its duration and failure.
+        """
+        try:
+            with metrics.ZABBIX_REQUESTS.time(method=method), \
+                    tracing.span('zabbix.api', method=method) as span:
+                if span:
+                    span.fields['params'] = len(json.dumps(params))
+
+                return self._post(method, params)
+
+        except Exception:
+            metrics.ZABBIX_ERRORS.inc(method=method)
+            raise
+
+    def _post(self, method, params):
+        """Sends the JSON-RPC request as ZabbixAPI.do_request does, but
+        without its debug logging, which formats every response as indented
+        JSON even when debug logging is off. For large results, like the
+        history of an item, that takes longer than the request itself.
+        """
+        zapi = self.zapi
+        request = {'jsonrpc': '2.0', 'method': method,
+                   'params': params or {}, 'id': zapi.id}
+        if zapi.auth and method != 'apiinfo.version':
+            request['auth'] = zapi.auth
+
+        response = zapi.session.post(zapi.url, data=json.dumps(request),
+                                     timeout=zapi.timeout)
+        response.raise_for_status()
+        if not response.content:
+            raise ZabbixAPIException('Received empty response')
+
+        try:
+            response_json = json.loads(response.content)
+
+        except ValueError:
+            raise ZabbixAPIException(
+                'Unable to parse json: {0}'.format(response.text))
+
+        zapi.id += 1
+        if 'error' in response_json:
+            error = response_json['error']
+            raise ZabbixAPIException('Error {0}: {1}, {2}'.format(
+                error['code'], error['message'],
+                error.get('data', 'No data')), error['code'])
+
+        return response_json
+
+    def __getattr__(self, attr):
+        return SessionObject(attr, self)
+
+
+class SessionObject(object):
+    """Counterpart of pyzabbix' ZabbixAPIObjectClass that routes the calls
+    through a Session.
+    """
+    def __init__(self, name, session):
+        self.name = name
+        self.session = session
+
+    def __getattr__(self, attr):
+        def call(*args, **kwargs):
+            if args and kwargs:
+                raise TypeError('Found both args and kwargs')
+
+            return self.session.do_request(
+                '{0}.{1}'.format(self.name, attr), args or kwargs)['result']
+
+        return call
+
+
+class HostgroupIndex(object):
+    """In-memory name to groupid index of the monitored host groups of a
+    realm. Names are matched case-insensitively, either exactly or by prefix.
+    """
+    def __init__(self, zapi, ttl=HOSTGROUP_TTL):
+        self.zapi = zapi
+        self.ttl = ttl
+        self.groups = {}
+        self.updated = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Downloads the monitored host groups.
+        """
+        self.load(self.zapi.hostgroup.get(**HOSTGROUP_GET))
+
+    def load(self, groups):
+        """Replaces the index with the given host groups.
+
+        :param groups: host groups as returned by hostgroup.get
+        :type groups: list
+        """
+        self.groups = {group['name'].lower(): group['groupid']
+                       for group in groups}
+        self.updated = time.time()
+        logging.debug('indexed %d host groups', len(self.groups))
+
+    def age(self):
+        """Returns the seconds since the index was loaded.
+        """
+        if self.updated is None:
+            return float('inf')
+
+        return time.time() - self.updated
+
+    def match(self, name):
+        """Returns the groupids matching the name. An exact match wins,
+        otherwise every group starting with the name matches. A trailing '*'
+        is accepted for prefixes.
+        """
+        name = name.lower().rstrip('*')
+        if name in self.groups:
+            return [self.groups[name]]
+
+        return [groupid for group, groupid in self.groups.items()
+                if group.startswith(name)]
+
+    def resolve(self, names):
+        """Resolves several group names at once.
+
+        :param names: host group names or prefixes
+        :type names: list
+        :return: {name: [groupid, ...]}, names without a match map to []
+        """
+        with self.lock:
+            if self.age() > self.ttl:
+                self.refresh()
+
+            result = {name: self.match(name) for name in names}
+            if (not all(result.values()) and
+                    self.age() > HOSTGROUP_MISS_INTERVAL):
+                self.refresh()
+                result = {name: self.match(name) for name in names}
+
+        return result
+
+
 def init(config):
-    """Initializes the ZabbixAPI with the config.
+    """Returns the Zabbix session for the config. Sessions are kept per
+    realm, so the login is only done once. Changed settings of a reloaded
+    config are applied to the existing session.
 
     :param config: config to use, as returned by read_config
     :type config: dict
-    :return: ZabbixAPI reference
+    :return: Session reference
+    """
+    key = _session_key(config)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None and session.config == config:
+            return session
+
+        # Logins to different realms must not wait for each other.
+        lock = _session_locks.setdefault(key, threading.Lock())
+
+    with lock:
+        with _sessions_lock:
+            session = _sessions.get(key)
+
+        if session is None:
+            session = Session(config)
+            with _sessions_lock:
+                _sessions[key] = session
+
+        elif session.config != config:
+            logging.info('applying the new settings of %s', config['host'])
+            session.configure(config)
+
+    return session
+
+
+def close_sessions(configs):
+    """Closes the sessions that none of the configs uses any more, those of
+    removed realms or of realms with a new host or credentials.
+
+    :param configs: the configs of all realms
+    :type configs: iterable
     """
-    zapi = ZabbixAPI(config['host'])
-    zapi.login(config['username'], config['password'])
-    return zapi
+    keys = {_session_key(config) for config in configs}
+    with _sessions_lock:
+        stale = [key for key in _sessions if key not in keys]
+        sessions = [_sessions.pop(key) for key in stale]
+        for key in stale:
+            _session_locks.pop(key, None)
+
+    for session in sessions:
+        logging.info('closing the session of %s', session.config['host'])
+        session.close()
+
+
+def _session_key(config):
+    return (config['host'], config['username'], config['password'])
 
 
 def trigger_info(zapi, trigger):
     """Retrieves the description, hostname, prevvalue and trigger_id for a
     given trigger.
 
-    :param zapi: reference to the ZabbixAPI
-    :type zapi: ZabbixAPI
+    Triggers fetched with TRIGGER_SELECT already carry their hosts and items,
+    for those no extra API calls are made.
+
+    :param zapi: reference to the Zabbix session
+    :type zapi: Session
     :param trigger: dictionary of retrieved trigger
     :type trigger: dict
     :return: description, hostname, prevvalue, trigger_id
     """
     trigger_id = trigger['triggerid']
     priority = PRIORITY[int(trigger['priority'])]
-    item = zapi.item.get(triggerids=trigger_id)[0]
+    if 'items' in trigger:
+        item = trigger['items'][0]
+
+    else:
+        item = zapi.item.get(triggerids=trigger_id)[0]
+
     hostid = item['hostid']
     prevvalue = item['prevvalue']
-    hostname = zapi.host.get(hostids=hostid)[0]['name']
+    for host in trigger.get('hosts', []):
+        if host['hostid'] == hostid:
+            hostname = host['name']
+            break
+
+    else:
+        hostname = zapi.host.get(hostids=hostid)[0]['name']
+
     description = re.sub('({HOST.HOST}|{HOST.NAME})',
                          hostname,
                          trigger['description'])
@@ -105,6 +491,188 @@ def trigger_info(zapi, trigger):
             'trigger_id': trigger_id}
 
 
+def _get_problem_triggers(zapi):
+    """Retrieves the triggers that are, or recently were, in a problem state
+    together with the acknowledge state of their last event. The triggers
+    come from the background synchronizer when the realm has one, otherwise
+    from a snapshot shared by all commands for the realm for a few seconds.
+
+    :param zapi: reference to the Zabbix session
+    :type zapi: Session
+    :return: list of raw triggers
+    """
+    if zapi.sync is not None:
+        triggers = zapi.sync.triggers()
+        if triggers is not None:
+            return triggers
+
+    return zapi.snapshots.get(
+        'problems', lambda: zapi.trigger.get(**PROBLEM_TRIGGERS))
+
+
+def _is_unacked(trigger):
+    """Tells whether the trigger is a problem with an unacknowledged last
+    event.
+
+    :param trigger: raw trigger as returned by _get_problem_triggers
+    :type trigger: dict
+    :return: bool
+    """
+    last_event = trigger.get('lastEvent') or {}
+    return (trigger['value'] == '1' and
+            last_event.get('acknowledged') == '0')
+
+
+def partition_triggers(zapi, triggers):
+    """Splits raw triggers into acked and unacked triggers in one pass.
+
+    :param zapi: reference to the Zabbix session
+    :type zapi: Session
+    :param triggers: raw triggers as returned by _get_problem_triggers
+    :type triggers: list
+    :return: acked triggers, unacked triggers
+    """
+    acked = []
+    unacked = []
+    for trigger in triggers:
+        if _is_unacked(trigger):
+            unacked.append(trigger_info(zapi, trigger))
+
+        else:
+            acked.append(trigger_info(zapi, trigger))
+
+    return acked, unacked
+
+
+def _get_selected_triggers(zapi, selectors, acked=None):
+    """Retrieves the problem triggers matching the selectors, filtered by
+    Zabbix.
+
+    :param zapi: reference to the Zabbix session
+    :type zapi: Session
+    :param selectors: as returned by parse_selectors
+    :type selectors: list
+    :param acked: False to only fetch the problems with an unacknowledged
+                  last event, True to only return the other triggers
+    :type acked: bool
+    :return: list of raw triggers
+    """
+    params = selector_params(zapi, selectors)
+    if params is None:
+        return []
+
+    params = dict(PROBLEM_TRIGGERS, **params)
+    limit = None
+    if acked is False:
+        # Exactly the triggers _is_unacked keeps, so a limit counts the
+        # listed triggers only.
+        params['withLastEventUnacknowledged'] = 1
+        params['filter'] = dict(params.get('filter', {}), value=1)
+
+    elif acked is True:
+        # Zabbix cannot select recovered or acknowledged triggers in one
+        # query, the limit is applied after filtering them here.
+        limit = params.pop('limit', None)
+
+    key = ('selected', json.dumps(params, sort_keys=True))
+    triggers = zapi.snapshots.get(key, lambda: zapi.trigger.get(**params))
+    if limit is not None:
+        triggers = [trigger for trigger in triggers
+                    if not _is_unacked(trigger)][:limit]
+
+    return triggers
+
+
+def iter_triggers(config, acked=None, selectors=None):
+    """Yields the triggers from Zabbix one by one, the enrichment is done
+    lazily.
+
+    :param config: config for zapi
+    :type config: dict
+    :param acked: True for the acked, False for the unacked and None for all
+                  triggers
+    :type acked: bool
+    :param selectors: filters as returned by parse_selectors
+    :type selectors: list
+    :return: generator of triggers
+    """
+    zapi = init(config)
+    if selectors:
+        triggers = _get_selected_triggers(zapi, selectors, acked)
+
+    else:
+        triggers = _get_problem_triggers(zapi)
+
+    for trigger in triggers:
+        if acked is None or acked is not _is_unacked(trigger):
+            yield trigger_info(zapi, trigger)
+
+
+def event_cursor(config):
+    """Returns the cursor of the newest event, watching starts after it.
+
+    :param config: config for zapi
+    :type config: dict
+    :return: {'eventid': int, 'clock': int}
+    """
+    zapi = init(config)
+    events = zapi.event.get(source=0, object=0, output=['eventid', 'clock'],
+                            sortfield=['eventid'], sortorder='DESC', limit=1)
+    if not events:
+        return {'eventid': 0, 'clock': int(time.time())}
+
+    return {'eventid': int(events[0]['eventid']),
+            'clock': int(events[0]['clock'])}
+
+
+def event_info(event):
+    """Returns the host, description, priority and problem state of an
+    event fetched with WATCH_EVENTS.
+
+    :param event: the raw event
+    :type event: dict
+    :return: dict
+    """
+    trigger = event.get('relatedObject') or {}
+    hostname = ', '.join(host['name'] for host in event.get('hosts', []))
+    description = event.get('name') or re.sub(
+        '({HOST.HOST}|{HOST.NAME})', hostname,
+        trigger.get('description', ''))
+    return {'hostname': hostname,
+            'description': description,
+            'priority': PRIORITY[int(trigger.get('priority', 0))],
+            'level': int(trigger.get('priority', 0)),
+            'problem': event['value'] == '1',
+            'trigger_id': event['objectid'],
+            'clock': int(event['clock'])}
+
+
+def iter_events(config, cursor, page=WATCH_PAGE):
+    """Yields the trigger events after the cursor, oldest first, fetching
+    them a page at a time. The cursor is moved along.
+
+    :param config: config for zapi
+    :type config: dict
+    :param cursor: as returned by event_cursor, updated in place
+    :type cursor: dict
+    :param page: events per event.get call
+    :type page: int
+    :return: generator of events as returned by event_info
+    """
+    zapi = init(config)
+    while True:
+        # Event ids only grow, unlike the clock of data from proxies.
+        events = zapi.event.get(eventid_from=str(cursor['eventid'] + 1),
+                                limit=page, **WATCH_EVENTS)
+        for event in events:
+            cursor['eventid'] = max(cursor['eventid'], int(event['eventid']))
+            cursor['clock'] = max(cursor['clock'], int(event['clock']))
+            yield event_info(event)
+
+        if len(events) < page:
+            return
+
+
 def get_triggers(config):
     """Retrieves all the triggers from Zabbix
 
@@ -112,14 +680,7 @@ def get_triggers(config):
     :type config: dict
     :return: list of triggers
     """
-    zapi = init(config)
-    all_triggers = zapi.trigger.get(only_true=1,
-                                skipDependent=1,
-                                monitored=1,
-                                active=1,
-                                output='extend',
-                                expandDescription=1)
-    return [trigger_info(zapi, trigger) for trigger in all_triggers]
+    return list(iter_triggers(config))
 
 
 def get_unacked_triggers(config):
@@ -129,20 +690,7 @@ def get_unacked_triggers(config):
     :type config: dict
     :return: list of triggers
     """
-    zapi = init(config)
-    all_triggers = zapi.trigger.get(only_true=1,
-                                skipDependent=1,
-                                monitored=1,
-                                active=1,
-                                output='extend',
-                                expandDescription=1,
-                                withLastEventUnacknowledged=1)
-    triggers = []
-    for trigger in all_triggers:
-        if trigger['value'] == '1':
-            triggers.append(trigger_info(zapi, trigger))
-
-    return triggers
+    return list(iter_triggers(config, acked=False))
 
 
 def get_acked_triggers(config):
@@ -152,14 +700,223 @@ def get_acked_triggers(config):
     :type config: dict
     :return: list of triggers
     """
-    all_triggers = get_triggers(config)
-    unacked_triggers = get_unacked_triggers(config)
-    triggers = []
-    for trigger in all_triggers:
-        if trigger not in unacked_triggers:
-            triggers.append(trigger)
+    return list(iter_triggers(config, acked=True))
+
+
+def get_triggers_by_ack(config):
+    """Retrieves all the triggers from Zabbix, split by their acknowledge
+    state.
+
+    :param config: config for zapi
+    :type config: dict
+    :return: acked triggers, unacked triggers
+    """
+    zapi = init(config)
+    return partition_triggers(zapi, _get_problem_triggers(zapi))
 
-    return triggers
+
+def parse_selectors(args):
+    """Parses selectors like 'host=web*' or 'severity<=warning'.
+
+    :param args: the selectors
+    :type args: list
+    :return: list of (key, operator, value) tuples
+    """
+    selectors = []
+    for arg in args:
+        match = SELECTOR.match(arg)
+        if match is None:
+            raise ValueError('invalid selector "{0}"'.format(arg))
+
+        selectors.append(match.groups())
+
+    return selectors
+
+
+def severity(value):
+    """Returns the priority number of a severity name or number.
+    """
+    if value.isdigit() and int(value) in PRIORITY:
+        return int(value)
+
+    value = value.lower().replace('_', ' ')
+    for priority, name in PRIORITY.items():
+        if name.lower().startswith(value):
+            return priority
+
+    raise ValueError('unknown severity "{0}"'.format(value))
+
+
+def selector_params(zapi, selectors):
+    """Translates selectors into trigger.get parameters. Supported are
+    host=, group= (names may end in '*'), severity with =, <, <=, >, >=,
+    min= as shorthand for severity>= and limit=, which returns the most
+    severe triggers first.
+
+    :param zapi: reference to the Zabbix session
+    :type zapi: Session
+    :param selectors: as returned by parse_selectors
+    :type selectors: list
+    :return: dict of parameters, None when nothing can match
+    """
+    params = {}
+    priorities = set(PRIORITY)
+    for key, op, value in selectors:
+        if key == 'host':
+            hosts = zapi.host.get(search={'name': value},
+                                  searchWildcardsEnabled=1,
+                                  output=['hostid'])
+            hostids = {host['hostid'] for host in hosts}
+            if 'hostids' in params:
+                hostids &= set(params['hostids'])
+
+            params['hostids'] = sorted(hostids)
+
+        elif key == 'group':
+            groupids = _hostgroups_to_ids(zapi, [value])
+            if 'groupids' in params:
+                groupids = set(groupids) & set(params['groupids'])
+
+            params['groupids'] = sorted(groupids)
+
+        elif key in ('severity', 'min'):
+            if key == 'min':
+                op = '>='
+
+            priority = severity(value)
+            priorities &= {level for level in PRIORITY
+                           if SEVERITY_OPERATORS[op](level, priority)}
+
+        elif key == 'limit':
+            if not value.isdigit():
+                raise ValueError('invalid limit "{0}"'.format(value))
+
+            params.update(limit=int(value),
+                          sortfield='priority',
+                          sortorder='DESC')
+
+        else:
+            raise ValueError('unknown selector "{0}"'.format(key))
+
+    if (params.get('hostids') == [] or params.get('groupids') == [] or
+            not priorities):
+        return None
+
+    if priorities == set(range(min(priorities), max(PRIORITY) + 1)):
+        if min(priorities) > 0:
+            params['min_severity'] = min(priorities)
+
+    else:
+        params['filter'] = {'priority': sorted(priorities)}
+
+    return params
+
+
+def _ack_plan(triggerids, triggers):
+    """Decides which events to acknowledge for the requested triggers.
+
+    :param triggerids: ids of the triggers to ack
+    :type triggerids: list
+    :param triggers: the triggers with their value and lastEvent
+    :type triggers: list
+    :return: ({triggerid: result} of the skipped triggers,
+              {triggerid: eventid} of the events to acknowledge)
+    """
+    triggers = {trigger['triggerid']: trigger for trigger in triggers}
+    results = {}
+    eventids = {}
+    for triggerid in triggerids:
+        trigger = triggers.get(triggerid)
+        if trigger is None or not trigger.get('lastEvent'):
+            results[triggerid] = 'no such trigger or no events'
+
+        elif trigger['value'] != '1':
+            results[triggerid] = 'not in a problem state'
+
+        elif trigger['lastEvent']['acknowledged'] == '1':
+            results[triggerid] = 'already acknowledged'
+
+        else:
+            eventids[triggerid] = trigger['lastEvent']['eventid']
+
+    return results, eventids
+
+
+def ack_triggers(config, triggerids):
+    """Acknowledges the last events of the given triggers with a single
+    event.acknowledge call.
+
+    :param config: config for zapi
+    :type config: dict
+    :param triggerids: ids of the triggers to ack
+    :type triggerids: list
+    :return: {triggerid: result}
+    """
+    zapi = init(config)
+    triggerids = list(dict.fromkeys(triggerids))
+    triggers = zapi.trigger.get(triggerids=triggerids, **ACK_TRIGGERS)
+    return _acknowledge(zapi, triggerids, triggers)
+
+
+def _acknowledge(zapi, triggerids, triggers):
+    """Acknowledges the last events of the triggers with a single
+    event.acknowledge call.
+
+    :param zapi: reference to the Zabbix session
+    :type zapi: Session
+    :param triggerids: ids of the triggers to ack
+    :type triggerids: list
+    :param triggers: the triggers, fetched with ACK_TRIGGERS
+    :type triggers: list
+    :return: {triggerid: result}
+    """
+    results, eventids = _ack_plan(triggerids, triggers)
+    if not eventids:
+        return results
+
+    try:
+        zapi.event.acknowledge(eventids=list(eventids.values()),
+                               **ACK_PARAMS)
+
+    except ZabbixAPIException as error:
+        results.update(dict.fromkeys(eventids, str(error)))
+        return results
+
+    zapi.snapshots.invalidate()
+    if zapi.sync is not None:
+        zapi.sync.acknowledged(list(eventids))
+
+    results.update(dict.fromkeys(eventids, 'acknowledged'))
+    return results
+
+
+def ack_selected(config, selectors):
+    """Acknowledges the unacknowledged problems matching the selectors.
+
+    :param config: config for zapi
+    :type config: dict
+    :param selectors: as returned by parse_selectors
+    :type selectors: list
+    :return: {triggerid: result}
+    """
+    zapi = init(config)
+    params = selector_params(zapi, selectors)
+    if params is None:
+        return {}
+
+    # The last events come along, so no second trigger.get is needed.
+    triggers = zapi.trigger.get(only_true=1,
+                                skipDependent=1,
+                                monitored=1,
+                                active=1,
+                                withLastEventUnacknowledged=1,
+                                **dict(ACK_TRIGGERS, **params))
+    triggerids = [trigger['triggerid'] for trigger in triggers
+                  if trigger['value'] == '1']
+    if not triggerids:
+        return {}
+
+    return _acknowledge(zapi, triggerids, triggers)
 
 
 def ack(config, triggerid):
@@ -170,20 +927,12 @@ def ack(config, triggerid):
     :param triggerid: id of the trigger to ack
     :type triggerid: str
     """
-    zapi = init(config)
-    event = zapi.event.get(objectids=triggerid)
-    try:
-        msg = zapi.event.acknowledge(
-            eventids=event[-1]['eventid'],
-            action=2,
-            message='Acknowledged by the Matrix-Zabbix bot')
-        return_string = "Trigger {0} acknowledged. {1}".format(
-            triggerid, msg)
+    result = ack_triggers(config, [triggerid])[triggerid]
+    if result == 'acknowledged':
+        return "Trigger {0} acknowledged.".format(triggerid)
 
-    except ZabbixAPIException as error:
-        return_string = str(error)
+    return "Trigger {0}: {1}".format(triggerid, result)
 
-    return return_string
 
 def hosts(config):
     """Retrieves the monitored hosts.
@@ -203,25 +952,37 @@ def hosts(config):
 
     return hosts
 
+def _hostgroups_to_ids(zapi, hostgroups):
+    """Retrieves the hostgroup ids for the given groups or group prefixes.
+
+    :param zapi: reference to the zabbix api
+    :type zapi: zabbix api
+    :param hostgroups: specifies the host groups
+    :type hostgroups: list
+    :return: list of group ids
+    """
+    groupids = []
+    for ids in zapi.hostgroup_index.resolve(hostgroups).values():
+        groupids.extend(ids)
+
+    return sorted(set(groupids))
+
+
 def _hostgroup_to_id(zapi, hostgroup):
-    """Retrieves the hostgroup id for a given group.
+    """Retrieves the hostgroup id for a given group. A prefix is accepted as
+    long as it matches one group only.
 
     :param zapi: reference to the zabbix api
     :type zapi: zabbix api
     :param hostgroup: specifies the host group
     :type hostgroup: str
-    :return: list of hosts
+    :return: group id or None
     """
-    groups = zapi.hostgroup.get(monitored_hosts=True)
-    for group in groups:
-        if group['name'] == hostgroup:
-            groupid = group['groupid']
-            break
-
-    else:
-        groupid = None
+    groupids = zapi.hostgroup_index.resolve([hostgroup])[hostgroup]
+    if len(groupids) == 1:
+        return groupids[0]
 
-    return groupid
+    return None
 
 
 def _get_hosts_in_groups(zapi, hostgroup):
@@ -254,6 +1015,34 @@ def get_hosts_in_groups(config, hostgroup):
     return _get_hosts_in_groups(zapi, hostgroup)
 
 
+def _get_itemvalue_table(zapi, hostids, keys):
+    """Retrieves the values of the keys for all the given hosts in a single
+    request. Keys are matched exactly.
+
+    :param zapi: the zabbix api reference
+    :type zapi: zapi
+    :param hostids: ids of the hosts
+    :type hostids: list
+    :param keys: keys to retrieve
+    :type keys: list
+    :return: {hostid: {key: {'lastvalue': .., 'lastclock': ..} or MISSING}}
+    """
+    table = {hostid: dict.fromkeys(keys, MISSING) for hostid in hostids}
+    if not hostids or not keys:
+        return table
+
+    items = zapi.item.get(hostids=hostids,
+                          filter={'key_': keys},
+                          output=['hostid', 'key_', 'lastvalue', 'lastclock'])
+    for item in items:
+        row = table.get(item['hostid'])
+        if row is not None and item['key_'] in row:
+            row[item['key_']] = {'lastvalue': item['lastvalue'],
+                                 'lastclock': item['lastclock']}
+
+    return table
+
+
 def _get_itemvalue(zapi, hostid, keys):
     """Retrieves the value for a hostid - key combination.
 
@@ -267,13 +1056,8 @@ def _get_itemvalue(zapi, hostid, keys):
     if isinstance(keys, str):
         keys = [keys]
 
-    data = []
-    for key in keys:
-        value = zapi.item.get(hostids=hostid, search={'key_': key})
-        if value:
-            data.append(value[0]['lastvalue'])
-
-    return data
+    row = _get_itemvalue_table(zapi, [hostid], keys)[hostid]
+    return [row[key]['lastvalue'] for key in keys if row[key] is not MISSING]
 
 
 def get_itemvalue(config, host, keys):
@@ -290,6 +1074,129 @@ def get_itemvalue(config, host, keys):
     return _get_itemvalue(zapi, host['hostid'], keys)
 
 
+def get_item(config, host, key):
+    """Retrieves the numeric item with the key on the host.
+
+    :param config: config for zapi
+    :type config: dict
+    :param host: technical or visible name of the host
+    :type host: str
+    :param key: the item key
+    :type key: str
+    :return: item with itemid, value_type, name and units
+    """
+    zapi = init(config)
+    hosts = zapi.host.get(filter={'host': host}, output=['hostid']) or \
+        zapi.host.get(filter={'name': host}, output=['hostid'])
+    items = []
+    if hosts:
+        items = zapi.item.get(hostids=hosts[0]['hostid'],
+                              filter={'key_': key},
+                              output=['itemid', 'value_type', 'name',
+                                      'units'])
+
+    if not items:
+        raise ValueError('no item "{0}" on host "{1}"'.format(key, host))
+
+    if items[0]['value_type'] not in NUMERIC:
+        raise ValueError('item "{0}" on host "{1}" is not numeric'.format(
+            key, host))
+
+    return items[0]
+
+
+def iter_history(config, item, time_from, time_till, page=HISTORY_PAGE):
+    """Yields the history of a numeric item in pages of at most `page`
+    values, oldest first.
+
+    :param config: config for zapi
+    :type config: dict
+    :param item: as returned by get_item
+    :type item: dict
+    :param time_from: start of the window, unix time
+    :type time_from: int
+    :param time_till: end of the window, unix time
+    :type time_till: int
+    :param page: values per history.get call
+    :type page: int
+    :return: generator of lists of {'clock': .., 'value': ..}
+    """
+    zapi = init(config)
+    while time_from <= time_till:
+        rows = zapi.history.get(history=int(item['value_type']),
+                                itemids=item['itemid'],
+                                time_from=time_from, time_till=time_till,
+                                sortfield='clock', sortorder='ASC',
+                                limit=page, output=['clock', 'value'])
+        if len(rows) < page:
+            yield rows
+            return
+
+        # Values within a second are not ordered, the last second of a
+        # full page is fetched again with the next page.
+        last = rows[-1]['clock']
+        complete = [row for row in rows if row['clock'] != last]
+        if not complete:
+            logging.debug('more than %d values of item %s at %s', page,
+                          item['itemid'], last)
+            complete = rows
+            last = int(last) + 1
+
+        yield complete
+        time_from = int(last)
+
+
+def iter_trends(config, item, time_from, time_till, page=TREND_PAGE):
+    """Yields the hourly trends of a numeric item, `page` hours at a time.
+
+    :param config: config for zapi
+    :type config: dict
+    :param item: as returned by get_item
+    :type item: dict
+    :param time_from: start of the window, unix time
+    :type time_from: int
+    :param time_till: end of the window, unix time
+    :type time_till: int
+    :param page: hours per trend.get call
+    :type page: int
+    :return: generator of lists of trend rows
+    """
+    zapi = init(config)
+    while time_from <= time_till:
+        till = min(time_from + page * 3600 - 1, time_till)
+        yield zapi.trend.get(itemids=item['itemid'], time_from=time_from,
+                             time_till=till,
+                             output=['clock', 'num', 'value_min',
+                                     'value_avg', 'value_max'])
+        time_from = till + 1
+
+
+def get_itemvalue_table(config, hostgroup, keys):
+    """Retrieves a host x key table of values for an entire group. Missing
+    values are marked with MISSING.
+
+    :param config: config for zapi
+    :type config: dict
+    :param hostgroup: hostgroup to query for
+    :type hostgroup: str
+    :param keys: keys to retrieve
+    :type keys: string or list
+    :return: {hostname: {key: {'lastvalue': .., 'lastclock': ..} or MISSING}}
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+
+    zapi = init(config)
+    groupid = _hostgroup_to_id(zapi, hostgroup)
+    if groupid is None:
+        return {}
+
+    hosts = zapi.host.get(groupids=groupid, output=['hostid', 'name'])
+    table = _get_itemvalue_table(
+        zapi, [host['hostid'] for host in hosts], keys)
+    return {host['name']: table[host['hostid']] for host in hosts}
+
+
 def get_itemvalues_for_group(config, hostgroup, keys):
     """Retrieves the key for an entire group.
 
@@ -300,13 +1207,13 @@ def get_itemvalues_for_group(config, hostgroup, keys):
     :param keys: keys to retrieve
     :type keys: string or list
     """
+    if isinstance(keys, str):
+        keys = [keys]
+
     data = {}
-    zapi = init(config)
-    hosts = _get_hosts_in_groups(zapi, hostgroup)
-    if hosts is not None:
-        for host in hosts:
-            value = _get_itemvalue(zapi, host['hostid'], keys)
-            data[host['name']] = value
+    for name, row in get_itemvalue_table(config, hostgroup, keys).items():
+        data[name] = [row[key]['lastvalue'] for key in keys
+                      if row[key] is not MISSING]
 
     return data
 
@@ -0,0 +1,459 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    asyncio counterpart of zabbix.py, built on aiohttp.
+Several API calls can be sent in one HTTP round trip as a JSON-RPC 2.0 batch.
+
+Requires the optional aiohttp dependency
+(pip install matrix-zabbix-bot[async]).
+Sessions are bound to the event loop they were created in and kept per loop.
+They are closed with close(), or when asyncio.run() shuts the loop down.
+"""
+import asyncio
+import itertools
+import logging
+
+import aiohttp
+from pyzabbix import ZabbixAPIException
+
+from zabbix import (ACK_PARAMS, ACK_TRIGGERS, HOSTGROUP_GET,
+                    HOSTGROUP_MISS_INTERVAL, HOSTGROUP_TTL, MISSING,
+                    PROBLEM_TRIGGERS, SESSION_EXPIRED, HostgroupIndex,
+                    trigger_info, _ack_plan, _is_unacked)
+
+# Connections kept open per realm.
+CONNECTIONS = 10
+
+# {(event loop, host, username, password): AsyncSession}
+_sessions = {}
+
+# {event loop: async generator closing its sessions at shutdown}
+_closers = {}
+
+
+class AsyncSession(object):
+    """Long-lived Zabbix JSON-RPC session over a pooled aiohttp connection.
+    Like zabbix.Session it logs in again when the session expired.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.url = config['host'].rstrip('/') + '/api_jsonrpc.php'
+        timeout = config.get('timeout')
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=CONNECTIONS),
+            timeout=aiohttp.ClientTimeout(total=timeout and float(timeout)),
+            headers={'Content-Type': 'application/json-rpc'})
+        self.auth = None
+        self.ids = itertools.count(1)
+        self.lock = asyncio.Lock()
+        self.hostgroup_index = HostgroupIndex(
+            None, config.get('hostgroup_ttl', HOSTGROUP_TTL))
+
+    async def login(self, stale=None):
+        """Logs in to Zabbix and stores the auth token, unless another call
+        already logged in while this one waited for the lock.
+
+        :param stale: the auth token that expired, None before the first
+                      login
+        :type stale: str
+        """
+        async with self.lock:
+            if self.auth is not None and self.auth != stale:
+                return
+
+            logging.debug('logging in to %s', self.config['host'])
+            self.auth = None
+            self.auth = await self._call('user.login', {
+                'user': self.config['username'],
+                'password': self.config['password']})
+
+    async def _post(self, payload):
+        async with self.http.post(self.url, json=payload) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    def _request(self, method, params):
+        request = {'jsonrpc': '2.0',
+                   'method': method,
+                   'params': params or {},
+                   'id': next(self.ids)}
+        if self.auth and method not in ('apiinfo.version', 'user.login'):
+            request['auth'] = self.auth
+
+        return request
+
+    @staticmethod
+    def _result(response):
+        if 'error' in response:
+            error = response['error']
+            raise ZabbixAPIException('Error {0}: {1}, {2}'.format(
+                error['code'], error['message'],
+                error.get('data', 'No data')), error['code'])
+
+        return response['result']
+
+    async def _call(self, method, params):
+        return self._result(await self._post(self._request(method, params)))
+
+    async def _batch(self, calls):
+        requests = [self._request(method, params) for method, params in calls]
+        responses = await self._post(requests)
+        if isinstance(responses, dict):
+            # A batch that fails as a whole gets a single error object.
+            responses = [responses] * len(requests)
+
+        by_id = {response.get('id'): response for response in responses}
+        results = []
+        for request in requests:
+            response = by_id.get(request['id'])
+            if response is None:
+                raise ZabbixAPIException(
+                    'no response to request {0} ({1}) in the batch'.format(
+                        request['id'], request['method']))
+
+            results.append(self._result(response))
+
+        return results
+
+    async def call(self, method, params=None):
+        """Performs a single API call.
+
+        :param method: Zabbix API method, e.g. 'trigger.get'
+        :type method: str
+        :param params: parameters for the method
+        :type params: dict or list
+        :return: the result of the call
+        """
+        return (await self.batch([(method, params)]))[0]
+
+    async def batch(self, calls):
+        """Performs several API calls in one HTTP round trip.
+
+        :param calls: (method, params) tuples
+        :type calls: list
+        :return: list of results in the order of the calls
+        """
+        if self.auth is None:
+            await self.login()
+
+        auth = self.auth
+        try:
+            return await self._batch(calls)
+
+        except ZabbixAPIException as error:
+            if SESSION_EXPIRED.search(str(error)) is None:
+                raise
+
+            logging.info('Zabbix session for %s expired, logging in again',
+                         self.config['host'])
+            await self.login(auth)
+            return await self._batch(calls)
+
+    async def close(self):
+        """Closes the HTTP connections of the session.
+        """
+        await self.http.close()
+
+
+def init(config):
+    """Returns the async Zabbix session for the config, one per realm and
+    event loop. Sessions left behind by closed loops are dropped.
+
+    :param config: config to use, as returned by read_config
+    :type config: dict
+    :return: AsyncSession reference
+    """
+    loop = asyncio.get_running_loop()
+    for closed in [key for key in _closers if key.is_closed()]:
+        del _closers[closed]
+
+    for key in [key for key in _sessions if key[0].is_closed()]:
+        logging.warning('dropping the Zabbix session of %s, its event loop '
+                        'closed without closing it', key[1])
+        del _sessions[key]
+
+    if loop not in _closers:
+        _closers[loop] = _closer()
+        # Start it, so the loop finalizes it in shutdown_asyncgens().
+        try:
+            _closers[loop].asend(None).send(None)
+
+        except StopIteration:
+            pass
+
+    key = (loop, config['host'], config['username'], config['password'])
+    session = _sessions.get(key)
+    if session is None:
+        session = AsyncSession(config)
+        _sessions[key] = session
+
+    return session
+
+
+async def close():
+    """Closes the sessions of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _sessions if key[0] is loop]:
+        await _sessions.pop(key).close()
+
+
+async def _closer():
+    """Closes the sessions of its loop once the loop shuts down its async
+    generators, as asyncio.run() does before closing the loop.
+    """
+    try:
+        yield
+
+    finally:
+        await close()
+
+
+async def _get_problem_triggers(zapi):
+    return await zapi.call('trigger.get', PROBLEM_TRIGGERS)
+
+
+def _trigger_info(trigger):
+    """zabbix.trigger_info for a trigger fetched with its hosts and items.
+    Its fallback of fetching those per trigger makes blocking calls, a
+    trigger that would need it is an error here.
+
+    :param trigger: raw trigger as fetched with PROBLEM_TRIGGERS
+    :type trigger: dict
+    :return: dict as returned by zabbix.trigger_info
+    """
+    items = trigger.get('items') or [{}]
+    hostids = {host['hostid'] for host in trigger.get('hosts', [])}
+    if items[0].get('hostid') not in hostids:
+        raise ZabbixAPIException('trigger {0} came without its host and '
+                                 'item'.format(trigger['triggerid']))
+
+    return trigger_info(None, trigger)
+
+
+async def get_triggers(config):
+    """Retrieves all the triggers from Zabbix
+
+    :param config: config for zapi
+    :type config: dict
+    :return: list of triggers
+    """
+    triggers = await _get_problem_triggers(init(config))
+    return [_trigger_info(trigger) for trigger in triggers]
+
+
+async def get_unacked_triggers(config):
+    """Retrieves the unacked triggers from Zabbix.
+
+    :param config: config for zapi
+    :type config: dict
+    :return: list of triggers
+    """
+    triggers = await _get_problem_triggers(init(config))
+    return [_trigger_info(trigger) for trigger in triggers
+            if _is_unacked(trigger)]
+
+
+async def get_acked_triggers(config):
+    """Retrieves the acked triggers from Zabbix.
+
+    :param config: config for zapi
+    :type config: dict
+    :return: list of triggers
+    """
+    triggers = await _get_problem_triggers(init(config))
+    return [_trigger_info(trigger) for trigger in triggers
+            if not _is_unacked(trigger)]
+
+
+async def get_triggers_by_ack(config):
+    """Retrieves all the triggers from Zabbix, split by their acknowledge
+    state.
+
+    :param config: config for zapi
+    :type config: dict
+    :return: acked triggers, unacked triggers
+    """
+    triggers = await _get_problem_triggers(init(config))
+    acked = []
+    unacked = []
+    for trigger in triggers:
+        if _is_unacked(trigger):
+            unacked.append(_trigger_info(trigger))
+
+        else:
+            acked.append(_trigger_info(trigger))
+
+    return acked, unacked
+
+
+async def ack_triggers(config, triggerids):
+    """Acknowledges the last events of the given triggers with a single
+    event.acknowledge call.
+
+    :param config: config for zapi
+    :type config: dict
+    :param triggerids: ids of the triggers to ack
+    :type triggerids: list
+    :return: {triggerid: result}
+    """
+    zapi = init(config)
+    triggerids = list(dict.fromkeys(triggerids))
+    triggers = await zapi.call('trigger.get',
+                               dict(ACK_TRIGGERS, triggerids=triggerids))
+    results, eventids = _ack_plan(triggerids, triggers)
+    if not eventids:
+        return results
+
+    try:
+        await zapi.call('event.acknowledge',
+                        dict(ACK_PARAMS, eventids=list(eventids.values())))
+        results.update(dict.fromkeys(eventids, 'acknowledged'))
+
+    except ZabbixAPIException as error:
+        results.update(dict.fromkeys(eventids, str(error)))
+
+    return results
+
+
+async def ack(config, triggerid):
+    """Ack the given trigger id.
+
+    :param config: config for zapi
+    :type config: dict
+    :param triggerid: id of the trigger to ack
+    :type triggerid: str
+    """
+    result = (await ack_triggers(config, [triggerid]))[triggerid]
+    if result == 'acknowledged':
+        return "Trigger {0} acknowledged.".format(triggerid)
+
+    return "Trigger {0}: {1}".format(triggerid, result)
+
+
+async def hosts(config):
+    """Retrieves the monitored hosts.
+
+    :param config: config for zapi
+    :type config: dict
+    """
+    info = await init(config).call('host.get', {'monitored': True})
+    return [{'hostname': host['name'],
+             'description': host['description'],
+             'status': host['status'],
+             'hostid': host['hostid']} for host in info]
+
+
+async def _hostgroups_to_ids(zapi, hostgroups):
+    """Retrieves the hostgroup ids for the given groups or group prefixes,
+    see zabbix.HostgroupIndex.
+
+    :param zapi: reference to the zabbix api
+    :type zapi: AsyncSession
+    :param hostgroups: specifies the host groups
+    :type hostgroups: list
+    :return: list of group ids
+    """
+    index = zapi.hostgroup_index
+    if index.age() > index.ttl:
+        index.load(await zapi.call('hostgroup.get', HOSTGROUP_GET))
+
+    result = {name: index.match(name) for name in hostgroups}
+    if not all(result.values()) and index.age() > HOSTGROUP_MISS_INTERVAL:
+        index.load(await zapi.call('hostgroup.get', HOSTGROUP_GET))
+        result = {name: index.match(name) for name in hostgroups}
+
+    return sorted({groupid for ids in result.values() for groupid in ids})
+
+
+async def get_hosts_in_groups(config, hostgroup):
+    """Retrieves the hosts from a specific group.
+
+    :param config: config for zapi
+    :type config: dict
+    :param hostgroup: specifies the host group
+    :type hostgroup: str
+    :return: list of hosts
+    """
+    zapi = init(config)
+    groupids = await _hostgroups_to_ids(zapi, [hostgroup])
+    if len(groupids) != 1:
+        return
+
+    return await zapi.call('host.get', {'groupids': groupids})
+
+
+async def get_itemvalue(config, host, keys):
+    """Retrieves the value for a host - key combination.
+
+    :param config: config for zapi
+    :type config: dict
+    :param host: host to query for
+    :type host: dict
+    :param keys: keys to retrieve
+    :type keys: string or list
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+
+    items = await init(config).call('item.get', {
+        'hostids': host['hostid'],
+        'filter': {'key_': keys},
+        'output': ['key_', 'lastvalue']})
+    values = {item['key_']: item['lastvalue'] for item in items}
+    return [values[key] for key in keys if key in values]
+
+
+async def get_itemvalue_table(config, hostgroup, keys):
+    """Retrieves a host x key table of values for an entire group, the hosts
+    and the items are fetched in one batch. Missing values are marked with
+    MISSING.
+
+    :param config: config for zapi
+    :type config: dict
+    :param hostgroup: hostgroup to query for
+    :type hostgroup: str
+    :param keys: keys to retrieve
+    :type keys: string or list
+    :return: {hostname: {key: {'lastvalue': .., 'lastclock': ..} or MISSING}}
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+
+    zapi = init(config)
+    groupids = await _hostgroups_to_ids(zapi, [hostgroup])
+    if len(groupids) != 1:
+        return {}
+
+    hosts, items = await zapi.batch([
+        ('host.get', {'groupids': groupids, 'output': ['hostid', 'name']}),
+        ('item.get', {'groupids': groupids,
+                      'filter': {'key_': keys},
+                      'output': ['hostid', 'key_', 'lastvalue',
+                                 'lastclock']}),
+    ])
+    table = {host['hostid']: dict.fromkeys(keys, MISSING) for host in hosts}
+    for item in items:
+        row = table.get(item['hostid'])
+        if row is not None and item['key_'] in row:
+            row[item['key_']] = {'lastvalue': item['lastvalue'],
+                                 'lastclock': item['lastclock']}
+
+    return {host['name']: table[host['hostid']] for host in hosts}
+
+
+async def get_itemvalues_for_group(config, hostgroup, keys):
+    """Retrieves the key for an entire group.
+
+    :param config: config for zapi
+    :type config: dict
+    :param hostgroup: hostgroup to query for
+    :type hostgroup: str
+    :param keys: keys to retrieve
+    :type keys: string or list
+    """
+    if isinstance(keys, str):
+        keys = [keys]
+
+    table = await get_itemvalue_table(config, hostgroup, keys)
+    return {name: [row[key]['lastvalue'] for key in keys
+                   if row[key] is not MISSING]
+            for name, row in table.items()}
@@ -3,49 +3,124 @@
 Description:    Zabbix bot responsible for !zabbix calls.
 """
 import argparse
+import collections
 import datetime
+import functools
+import itertools
 import logging
+import re
+import signal
+import threading
 import time
 import pdb
 
 import yaml
+import matrix_bot_api.matrix_bot_api
 from matrix_bot_api.matrix_bot_api import MatrixBotAPI
 from matrix_bot_api.mregex_handler import MRegexHandler
 
 import zabbix
 import matrix
+import matrix_sync
+import dispatch
+import bot_config
+import send_queue
+import pager
 import matrix_alert
+import metrics
+import tracing
+import watch
+import graph
 from matrix import set_log_level
 
+# Whether the listings show acked (True), unacked (False) or all triggers.
+ACKED = {'all': None, 'acked': True, 'unacked': False}
 
-def _room_init(room):
+# Priority name to level, for merging the triggers of several realms.
+PRIORITIES = {name: level for level, name in zabbix.PRIORITY.items()}
+
+# A trigger id, optionally tagged with its realm, e.g. home:1234.
+TRIGGER_ID = re.compile(r'^(?:([^:\s]+):)?(\d+)$')
+
+# Window of !zabbix graph when none is given.
+GRAPH_WINDOW = '1h'
+
+
+def _room_init(room, snapshot):
     """Boilerplate code for identifying the room.
 
     :param room: reference to the room
     :type room: matrix room object
-    :return: room_id, zabbix_config
+    :param snapshot: the configuration
+    :type snapshot: bot_config.Snapshot
+    :return: room_id, realms of the room
     """
     room_id = room.room_id
     logging.debug('got a message from room: %s', room_id)
-    if room_id in config['zabbix-bot']:
-        zabbix_config = _zabbix_config(room_id)
-
-    else:
+    if room_id not in snapshot.rooms:
         raise RuntimeError('room_id "{0}" is unkown'.format(room_id))
 
-    return (room_id, zabbix_config)
+    return (room_id, snapshot.rooms[room_id])
 
 
-def _zabbix_config(room_id):
-    """Returns the zabbix configuration for a given room_id.
+def _select_realms(realms, args):
+    """Picks the realms a command runs against: every realm of the room for
+    @all, the named realms for @name and otherwise the realms of the room.
+    A room cannot name realms it is not mapped to.
 
-    :param room_id: the Matrix room id
-    :type room_id: str
-    :return: zabbix config directionary
+    :param realms: the realms of the room
+    :type realms: tuple
+    :param args: the arguments of the command
+    :type args: list
+    :return: realms, args without the realm arguments
+    """
+    selected = []
+    rest = []
+    for arg in args:
+        if arg == '@all':
+            selected.extend(realms)
+
+        elif arg.startswith('@'):
+            if arg[1:] not in realms:
+                raise ValueError('realm "{0}" is not mapped to this '
+                                 'room'.format(arg[1:]))
+
+            selected.append(arg[1:])
+
+        else:
+            rest.append(arg)
+
+    return tuple(dict.fromkeys(selected)) or realms, rest
+
+
+def _zabbix_configs(realms, snapshot):
+    """Returns the zabbix configurations of the realms.
+
+    :param realms: the realms
+    :type realms: tuple
+    :param snapshot: the configuration
+    :type snapshot: bot_config.Snapshot
+    :return: OrderedDict of realm to zabbix config dictionary
     """
-    zabbix_realm = config['zabbix-bot'][room_id]
-    zabbix_config = config['zabbix'][zabbix_realm]
-    return zabbix_config
+    return collections.OrderedDict(
+        (realm, snapshot.realms[realm]) for realm in realms)
+
+
+def _fan_out(function, items):
+    """Calls function(realm, ...) for every item concurrently, see
+    dispatch.CommandPool.fan_out. Every call counts against the per_realm
+    limit of its realm. The spans of every realm end up in the trace of the
+    command.
+
+    :return: list of (result, error) tuples in the order of the items
+    """
+    trace = tracing.current()
+
+    def run(realm, *args):
+        with tracing.activate(trace.fork(realm=realm) if trace else None):
+            return function(realm, *args)
+
+    return commands.fan_out(run, items)
 
 
 def _error(matrix_config, room, error):
@@ -62,8 +137,7 @@ def _error(matrix_config, room, error):
     logging.error(error, exc_info=True)
     message = "{0}<br /><br />Please see my log.".format(
         str(error))
-    matrix_config['message'] = message
-    matrix.send_message(matrix_config, room)
+    outbox.put(room.room_id, message, matrix_config['message_type'])
 
 
 def _zabbix_help():
@@ -84,8 +158,28 @@ def _zabbix_help():
         "<br />"
         "unacked: retrieves unacked triggers"
         "<br />"
-        "ack $trigger_id: acknowledges the trigger with the given id "
+        "ack $trigger_id ...: acknowledges the triggers with the given ids "
         "(the number between brackets)"
+        "<br />"
+        "ack host=web* severity<=warning: acknowledges the problems "
+        "matching all selectors (host=, group=, severity with =, <, <=, "
+        ">, >=, min=)"
+        "<br />"
+        "more: shows the next page of the previous list"
+        "<br />"
+        "watch [min=severity]: posts new problems and recoveries in this "
+        "room as they happen, watch off stops it"
+        "<br />"
+        "graph $host $key [window]: draws the values of an item over the "
+        "last window, e.g. 30m, 6h, 2d or 1w (default 1h)"
+        "<br /><br />"
+        "all, acked and unacked take filters, e.g. "
+        "!zabbix unacked min=high host=web* group=Clustermanagers limit=20"
+        "<br /><br />"
+        "@all or @realm runs a command against all or the named Zabbix "
+        "servers at once, trigger ids are then shown as realm:id."
+        "<br /><br />"
+        "Any command followed by --trace also shows where its time went."
         "<br /><br />"
         "Without any arguments this command gives unacknowledged "
         "triggers from the configured Zabbix server."
@@ -93,21 +187,15 @@ def _zabbix_help():
     return help_text
 
 
-def _zabbix_unacked_triggers(zabbix_config):
-    """Retrieves the unacked triggers from zabbix.
+def _format_triggers(triggers, colors):
+    """Formats triggers as colorized lines.
 
-    :param zabbix_config: zabbix configuration
-    :type zabbix_config: dict
-    :return: messages to return to matrix
+    :param triggers: triggers as returned by zabbix.trigger_info
+    :type triggers: list
+    :param colors: the color table
+    :type colors: matrix_alert.ColorTable
+    :return: generator of lines
     """
-    messages = []
-    triggers = zabbix.get_unacked_triggers(zabbix_config)
-    color_config = {}
-    for key, value in matrix.read_config(config['config'])['colors'].items():
-        if key.startswith('zabbix'):
-            key = key.replace('zabbix_', '')
-            color_config[key] = value
-
     for trigger in triggers:
         message = ("{prio} {name} {desc}: {value} "
                    "({triggerid})").format(
@@ -116,144 +204,498 @@ def _zabbix_unacked_triggers(zabbix_config):
             desc=trigger['description'],
             value=trigger['prevvalue'],
             triggerid=trigger['trigger_id'])
-        formatted_message = matrix_alert.colorize(
-            color_config, message)
-        messages.append(formatted_message)
-
-    return "<br />".join(messages)
+        yield matrix_alert.colorize_priority(
+            colors, trigger['priority'], message)
 
 
-def _zabbix_acked_triggers(zabbix_config):
-    """Retrieves the acked triggers from zabbix.
+def _zabbix_unacked_triggers(zabbix_config, colors, selectors=None):
+    """Retrieves the unacked triggers from zabbix.
 
     :param zabbix_config: zabbix configuration
     :type zabbix_config: dict
-    :return: messages to return to matrix
+    :param colors: the color table
+    :type colors: matrix_alert.ColorTable
+    :param selectors: filters as returned by zabbix.parse_selectors
+    :type selectors: list
+    :return: generator of lines
     """
-    messages = []
-    triggers = zabbix.get_acked_triggers(zabbix_config)
-    color_config = {}
-    for key, value in matrix.read_config(config['config'], 'Colors').items():
-        if key.startswith('zabbix'):
-            key = key.replace('zabbix_', '')
-            color_config[key] = value
+    return _format_triggers(
+        zabbix.iter_triggers(zabbix_config, acked=False, selectors=selectors),
+        colors)
 
-    for trigger in triggers:
-        message = ("{prio} {name} {desc}: {value} "
-                   "({triggerid})").format(
-            prio=trigger['priority'],
-            name=trigger['hostname'],
-            desc=trigger['description'],
-            value=trigger['prevvalue'],
-            triggerid=trigger['trigger_id'])
-        formatted_message = matrix_alert.colorize(
-            color_config, message)
-        messages.append(formatted_message)
 
-    return "<br />".join(messages)
+def _zabbix_acked_triggers(zabbix_config, colors, selectors=None):
+    """Retrieves the acked triggers from zabbix.
+
+    :param zabbix_config: zabbix configuration
+    :type zabbix_config: dict
+    :param colors: the color table
+    :type colors: matrix_alert.ColorTable
+    :param selectors: filters as returned by zabbix.parse_selectors
+    :type selectors: list
+    :return: generator of lines
+    """
+    return _format_triggers(
+        zabbix.iter_triggers(zabbix_config, acked=True, selectors=selectors),
+        colors)
 
 
-def _zabbix_all_triggers(zabbix_config):
+def _zabbix_all_triggers(zabbix_config, colors, selectors=None):
     """Retrieves the all triggers from zabbix regardless of their
     status.
 
     :param zabbix_config: zabbix configuration
     :type zabbix_config: dict
+    :param colors: the color table
+    :type colors: matrix_alert.ColorTable
+    :param selectors: filters as returned by zabbix.parse_selectors
+    :type selectors: list
+    :return: generator of lines
+    """
+    return _format_triggers(
+        zabbix.iter_triggers(zabbix_config, selectors=selectors), colors)
+
+
+def _zabbix_realms_triggers(configs, colors, acked, selectors=None):
+    """Retrieves the triggers of several realms concurrently, merged with
+    the most severe first. Trigger ids are tagged with their realm.
+
+    :param configs: zabbix configuration per realm
+    :type configs: OrderedDict
+    :param colors: the color table
+    :type colors: matrix_alert.ColorTable
+    :param acked: True for the acked, False for the unacked and None for all
+                  triggers
+    :type acked: bool
+    :param selectors: filters as returned by zabbix.parse_selectors
+    :type selectors: list
+    :return: iterator of lines
+    """
+    def fetch(realm, zabbix_config):
+        return list(zabbix.iter_triggers(zabbix_config, acked=acked,
+                                         selectors=selectors))
+
+    errors = []
+    triggers = []
+    results = _fan_out(fetch, list(configs.items()))
+    for realm, (result, error) in zip(configs, results):
+        if error is not None:
+            logging.error(error, exc_info=error)
+            errors.append("Realm {0}: {1}".format(realm, error))
+            continue
+
+        triggers.extend(
+            dict(trigger,
+                 trigger_id='{0}:{1}'.format(realm, trigger['trigger_id']))
+            for trigger in result)
+
+    triggers.sort(key=lambda trigger: PRIORITIES[trigger['priority']],
+                  reverse=True)
+    limits = [int(value) for key, _, value in selectors or []
+              if key == 'limit']
+    if limits:
+        del triggers[min(limits):]
+
+    return itertools.chain(errors, _format_triggers(triggers, colors))
+
+
+def _zabbix_acknowledge(snapshot, realms, configs, args):
+    """Acknowledges triggers by id and/or selectors like host=web* or
+    severity<=warning. Ids may be tagged with a realm of the room, e.g.
+    home:1234, selectors apply to every realm of the command. The realms are
+    handled concurrently.
+
+    :param snapshot: the configuration the command runs with
+    :type snapshot: bot_config.Snapshot
+    :param realms: the realms of the room
+    :type realms: tuple
+    :param configs: zabbix configuration per realm
+    :type configs: OrderedDict
+    :param args: trigger ids and selectors
+    :type args: list
     :return: messages to return to matrix
     """
+    multi = len(configs) > 1
+    triggerids = collections.OrderedDict((realm, []) for realm in configs)
+    results = collections.OrderedDict()
+    selector_args = []
+    tagged = multi
+    for arg in args:
+        match = TRIGGER_ID.match(arg)
+        if match is None:
+            selector_args.append(arg)
+
+        elif match.group(1) is None and multi:
+            results[arg] = "several realms, use realm:{0}".format(arg)
+
+        elif match.group(1) is None:
+            triggerids[next(iter(configs))].append(arg)
+
+        elif match.group(1) not in realms:
+            results[arg] = "realm not mapped to this room"
+
+        else:
+            tagged = True
+            triggerids.setdefault(match.group(1), []).append(match.group(2))
+
+    selectors = zabbix.parse_selectors(selector_args)
+
+    def acknowledge(realm, ids):
+        zabbix_config = snapshot.realms[realm]
+        acked = {}
+        if selectors and realm in configs:
+            acked.update(zabbix.ack_selected(zabbix_config, selectors))
+
+        if ids:
+            acked.update(zabbix.ack_triggers(zabbix_config, ids))
+
+        return acked
+
+    work = [(realm, ids) for realm, ids in triggerids.items()
+            if ids or (selectors and realm in configs)]
     messages = []
-    triggers = zabbix.get_triggers(zabbix_config)
-    color_config = {}
-    for key, value in matrix.read_config(config['config'], 'Colors').items():
-        if key.startswith('zabbix'):
-            key = key.replace('zabbix_', '')
-            color_config[key] = value
+    for (realm, _), (acked, error) in zip(work, _fan_out(acknowledge, work)):
+        if error is not None and not tagged:
+            raise error
 
-    for trigger in triggers:
-        message = ("{prio} {name} {desc}: {value} "
-                   "({triggerid})").format(
-            prio=trigger['priority'],
-            name=trigger['hostname'],
-            desc=trigger['description'],
-            value=trigger['prevvalue'],
-            triggerid=trigger['trigger_id'])
-        formatted_message = matrix_alert.colorize(
-            color_config, message)
-        messages.append(formatted_message)
+        if error is not None:
+            logging.error(error, exc_info=error)
+            messages.append("Realm {0}: {1}".format(realm, error))
+            continue
+
+        for trigger_id, result in acked.items():
+            if tagged:
+                trigger_id = '{0}:{1}'.format(realm, trigger_id)
+
+            results[trigger_id] = result
+
+    for trigger_id, result in results.items():
+        messages.append("Trigger {0}: {1}".format(trigger_id, result))
+
+    if not messages:
+        messages.append("No matching triggers")
 
     return "<br />".join(messages)
 
 
-def _zabbix_acknowledge_trigger(zabbix_config, trigger_id):
-    """Acknowledges a trigger with the given id.
+def _zabbix_watch(realms, room_id, args):
+    """Subscribes the room to the events of the realms, or unsubscribes it
+    with `off`.
 
-    :param zabbix_config: zabbix configuration
-    :type zabbix_config: dict
-    :param trigger_id: id to acknowledge
-    :type trigger_id: int
+    :param realms: the realms the command runs against
+    :type realms: tuple
+    :param room_id: the Matrix room id
+    :type room_id: str
+    :param args: `off` or a min= selector
+    :type args: list
+    :return: messages to return to matrix
+    """
+    if args == ['off']:
+        stopped = watches.unwatch(room_id, realms)
+        if not stopped:
+            return "Not watching {0}".format(', '.join(realms))
+
+        return "Stopped watching {0}".format(', '.join(stopped))
+
+    level = 0
+    for key, _, value in zabbix.parse_selectors(args):
+        if key != 'min':
+            raise ValueError('watch only takes min=, not "{0}"'.format(key))
+
+        level = zabbix.severity(value)
+
+    watches.watch(room_id, realms, level)
+    return "Watching {0} for problems of {1} and up".format(
+        ', '.join(realms), zabbix.PRIORITY[level])
+
+
+def _zabbix_graph(configs, args):
+    """Draws the values of an item over a window as a sparkline. Windows
+    longer than the trend_window of the realm are read from the trends.
+
+    :param configs: zabbix configuration per realm
+    :type configs: OrderedDict
+    :param args: host, key and optionally the window
+    :type args: list
+    :return: messages to return to matrix
+    """
+    if len(configs) > 1:
+        raise ValueError('graph takes a single realm, use @realm')
+
+    (zabbix_config,) = configs.values()
+    host, key = args[:2]
+    window = args[2] if len(args) > 2 else GRAPH_WINDOW
+    seconds = graph.parse_window(window)
+    item = zabbix.get_item(zabbix_config, host, key)
+    time_till = int(time.time())
+    time_from = time_till - seconds
+    downsampler = graph.Downsampler(time_from, time_till)
+    if seconds > int(zabbix_config.get('trend_window', zabbix.TREND_WINDOW)):
+        for rows in zabbix.iter_trends(zabbix_config, item, time_from,
+                                       time_till):
+            downsampler.add_trends(rows)
+
+    else:
+        for rows in zabbix.iter_history(zabbix_config, item, time_from,
+                                        time_till):
+            downsampler.add_history(rows)
+
+    summary = downsampler.summary()
+    if summary is None:
+        return "No values of {0} on {1} in the last {2}".format(
+            key, host, window)
+
+    return ("{host}: {name} ({key}), last {window}<br />"
+            "<code>{line}</code><br />"
+            "min {0:.4g}{units}, avg {1:.4g}{units}, max {2:.4g}{units} "
+            "({values} values)").format(
+        *summary, host=host, name=item['name'], key=key, window=window,
+        line=graph.sparkline(downsampler.buckets()), units=item['units'],
+        values=downsampler.values)
+
+
+def _watch_deliver(realm, room_id, events):
+    """Posts the new events of a realm to a room watching it, split into
+    messages of at most page_size bytes.
+
+    :param realm: the realm of the events
+    :type realm: str
+    :param room_id: the Matrix room id
+    :type room_id: str
+    :param events: events as returned by zabbix.event_info
+    :type events: list
+    """
+    snapshot = settings.get()
+    colors = snapshot.colors
+    tagged = len(watches.watched(room_id)) > 1
+    lines = []
+    for event in events:
+        trigger_id = event['trigger_id']
+        if tagged:
+            trigger_id = '{0}:{1}'.format(realm, trigger_id)
+
+        message = "{state} {prio} {name} {desc} ({triggerid})".format(
+            state='PROBLEM' if event['problem'] else 'RESOLVED',
+            prio=event['priority'],
+            name=event['hostname'],
+            desc=event['description'],
+            triggerid=trigger_id)
+        lines.append(matrix_alert.colorize_priority(
+            colors, event['priority'], message))
+
+    page_size = int(snapshot.matrix.get('page_size', pager.PAGE_SIZE))
+    for page, _ in pager.paginate(lines, page_size):
+        outbox.put(room_id, page, snapshot.matrix['message_type'])
+
+
+def _page(page):
+    """Adds a hint for the next page to a page.
+
+    :param page: (page, more) as returned by pager.Pagers
+    :type page: tuple
     :return: messages to return to matrix
     """
+    page, more = page
+    if more:
+        page += "<br /><br />More results: !zabbix more"
+
+    return page
+
+
+def _zabbix_command(snapshot, configs, room_id, args):
+    """Runs a !zabbix command. Trigger lists are returned a page at a time.
+
+    :param snapshot: the configuration the command runs with
+    :type snapshot: bot_config.Snapshot
+    :param configs: zabbix configuration per realm the command runs against
+    :type configs: OrderedDict
+    :param room_id: the Matrix room id
+    :type room_id: str
+    :param args: the arguments of the command
+    :type args: list
+    :return: messages to return to matrix
+    """
+    listings = {'all': _zabbix_all_triggers,
+                'acked': _zabbix_acked_triggers,
+                'unacked': _zabbix_unacked_triggers}
     messages = []
-    messages.append(zabbix.ack(zabbix_config, trigger_id))
-    return "<br />".join(messages)
+    listing = None
+    if not args or zabbix.SELECTOR.match(args[0]):
+        # Without a command the unacked triggers are listed.
+        args = ['unacked'] + args
 
+    arg = args[0]
+    if arg in listings:
+        listing = listings[arg]
+        selectors = zabbix.parse_selectors(args[1:])
 
-def zabbix_callback(room, event):
-    """Callback function for the !zabbix matches.
+    elif arg == 'more' and len(args) == 1:
+        messages = _page(pagers.more(room_id))
+
+    elif arg == 'ack' and len(args) > 1:
+        messages = _zabbix_acknowledge(snapshot, snapshot.rooms[room_id],
+                                       configs, args[1:])
+
+    elif arg == 'watch':
+        messages = _zabbix_watch(tuple(configs), room_id, args[1:])
+
+    elif arg == 'graph' and 3 <= len(args) <= 4:
+        messages = _zabbix_graph(configs, args[1:])
+
+    #     elif arg == 'hosts':
+    #         hosts = zabbix.hosts(zabbix_config)
+
+    else:
+        messages = _zabbix_help()
+
+    if listing is not None:
+        page_size = int(snapshot.matrix.get('page_size', pager.PAGE_SIZE))
+        # Fetching happens lazily while formatting, the API calls are
+        # nested spans.
+        with tracing.span('format'):
+            if len(configs) > 1:
+                lines = _zabbix_realms_triggers(configs, snapshot.colors,
+                                                ACKED[arg], selectors)
+
+            else:
+                (zabbix_config,) = configs.values()
+                lines = listing(zabbix_config, snapshot.colors, selectors)
+
+            messages = _page(pagers.start(room_id, lines, page_size))
+
+    if len(messages) == 0:
+        messages = 'Nothing to notify'
+
+    return messages
+
+
+def _command_name(args):
+    """Returns the name of the command in args, as used in the metrics.
+    """
+    args = [arg for arg in args if not arg.startswith('@')]
+    if not args or zabbix.SELECTOR.match(args[0]):
+        return 'unacked'
+
+    if args[0] in ('all', 'acked', 'unacked', 'more', 'ack', 'watch',
+                   'graph'):
+        return args[0]
+
+    return 'help'
+
+
+def _timed_command(received, trace, snapshot, configs, room_id, args):
+    """Runs _zabbix_command, recording the time since the command was
+    received, including the wait for a worker, and its trace.
+
+    :param received: time.time() of receiving the command
+    :type received: float
+    :param trace: the trace of the command, None when not tracing
+    :type trace: tracing.Trace
+    :return: messages to return to matrix, trace
+    """
+    if trace is not None:
+        trace.add('queue', time.time() - trace.queued)
+
+    try:
+        with tracing.activate(trace):
+            messages = _zabbix_command(snapshot, configs, room_id, args)
+
+    except Exception:
+        if trace is not None:
+            trace.log()
+
+        raise
+
+    finally:
+        metrics.COMMANDS.observe(time.time() - received,
+                                 command=_command_name(args))
+
+    if trace is not None and trace.reply:
+        messages += "<br /><br />" + trace.summary()
+
+    return messages, trace
+
+
+def _deliver(room, future):
+    """Sends the outcome of a command to the room it came from.
 
     :param room: reference to the room
-    :type room: room thingie
-    :param event: the message, essentially
-    :type event: event
+    :type room: matrix room object
+    :param future: the finished command
+    :type future: concurrent.futures.Future
     """
+    matrix_config = settings.get().matrix
     try:
-        room_id, zabbix_config = _room_init(room)
-        if room_id is None:
-            return
+        messages, trace = future.result()
 
-        args = event['content']['body'].split()
-        args.pop(0)
-        messages = []
-        if len(args) == 0:
-            messages = _zabbix_unacked_triggers(zabbix_config)
+    except Exception as error:  # Keep running!
+        return _error(matrix_config, room, error)
 
-        elif len(args) == 1:
-            arg = args[0]
-            if arg == 'all':
-                messages = _zabbix_all_triggers(zabbix_config)
+    outbox.put(room.room_id, messages, matrix_config['message_type'],
+               sent=trace.sent if trace is not None else None)
 
-            elif arg == 'acked':
-                messages = _zabbix_acked_triggers(zabbix_config)
 
-            elif arg == 'unacked':
-                messages = _zabbix_unacked_triggers(zabbix_config)
+def _send(room_id, message, message_type):
+    """Sends a message from the outbox.
 
-        #     elif arg == 'hosts':
-        #         hosts = zabbix.hosts(zabbix_config)
+    :param room_id: the Matrix room id
+    :type room_id: str
+    :param message: the html message
+    :type message: str
+    :param message_type: the message type
+    :type message_type: str
+    """
+    room = bot.client.rooms.get(room_id)
+    if room is None:
+        room = bot.client.join_room(room_id)
 
-            else:
-                messages = _zabbix_help()
+    matrix.send_message(
+        dict(settings.current.matrix, message=message,
+             message_type=message_type), room)
 
-        elif len(args) == 2:
-            if args[0] == 'ack':
-                trigger_id = args[1]
-                messages = _zabbix_acknowledge_trigger(
-                    zabbix_config, trigger_id)
 
-            else:
-                messages = _zabbix_help()
+def zabbix_callback(room, event):
+    """Callback function for the !zabbix matches. The command itself runs on
+    the worker pool, so the sync loop is not blocked by a slow Zabbix.
 
-        else:
-            messages = _zabbix_help()
+    :param room: reference to the room
+    :type room: room thingie
+    :param event: the message, essentially
+    :type event: event
+    """
+    received = time.time()
+    try:
+        args = event['content']['body'].split()
+        args.pop(0)
+        trace = None
+        reply_trace = bool(args) and args[-1] == '--trace'
+        if reply_trace:
+            args.pop()
 
-        if len(messages) == 0:
-            messages = 'Nothing to notify'
+        if tracing.ENABLED or reply_trace:
+            trace = tracing.Trace(_command_name(args), room.room_id,
+                                  reply=reply_trace)
 
-        matrix_config['message'] = messages
-        matrix.send_message(matrix_config, room)
+        with trace.span('config') if trace else tracing.NO_SPAN:
+            snapshot = settings.get()
+            room_id, realms = _room_init(room, snapshot)
+            realms, args = _select_realms(realms, args)
+            configs = _zabbix_configs(realms, snapshot)
+
+        if room_id is None:
+            return
+
+        if trace is not None:
+            trace.queued = time.time()
+
+        # A command for several realms takes a slot per realm when it
+        # fans out.
+        commands.submit(room, realms[0] if len(realms) == 1 else None,
+                        _timed_command, received, trace, snapshot,
+                        configs, room_id, args)
 
     except Exception as error:  # Keep running!
-        return _error(matrix_config, room, error)
+        return _error(settings.current.matrix, room, error)
 
 
 def flags():
@@ -270,26 +712,47 @@ def flags():
     parser.add_argument('-d', '--debug', action='store_const', dest='debug',
                         const=True, default=False,
                         help='enables the debug output')
+    parser.add_argument('-t', '--trace', action='store_const', dest='trace',
+                        const=True, default=False,
+                        help=('logs a timing trace of every command (also '
+                              'enabled by ZABBIX_BOT_TRACE=1)'))
     return vars(parser.parse_args())
 
 
 def main():
     """Main function.
     """
+    global bot, commands, outbox, pagers, watches
     zabbix.logging = logging
     matrix.logging = logging
-    config['config'] = args['config']
+    # Reload outside the signal handler, which may interrupt a thread
+    # holding the locks the reload takes.
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(
+        target=settings.reload, name='reload').start())
+    config = settings.current.raw
+    # The login, homeserver, spool and sync settings need a restart.
+    matrix_config = settings.current.matrix
+    workers = config.get('workers', {})
+    commands = dispatch.CommandPool(
+        _deliver,
+        workers=int(workers.get('threads', dispatch.WORKERS)),
+        per_realm=int(workers.get('per_realm', dispatch.PER_REALM)))
 
     # Create an instance of the MatrixBotAPI
     homeserver = "https://{server}:{port}".format(
         server=matrix_config['homeserver'], port=int(matrix_config['port']))
-    rooms = list(config['zabbix-bot'].keys())
+    rooms = list(settings.current.rooms.keys())
     token = None
     username = matrix_config['username']
     if 'token' in matrix_config:
         token = matrix_config['token']
         username = matrix_config['user_id']
 
+    # MatrixBotAPI creates its own client, which syncs right away. Swap in
+    # the filtered client that resumes from the saved sync token.
+    matrix_bot_api.matrix_bot_api.MatrixClient = functools.partial(
+        matrix_sync.SyncClient, state_path=matrix_config.get('sync_state'),
+        rooms=rooms)
     bot = MatrixBotAPI(
         username,
         matrix_config['password'],
@@ -298,6 +761,24 @@ def main():
         token=token,
     )
 
+    pagers = pager.Pagers()
+    outbox = send_queue.SendQueue(_send, matrix_config.get('spool'))
+    outbox.start()
+
+    watch_config = config.get('watch') or {}
+    watches = watch.Watches(
+        lambda: settings.get().realms, _watch_deliver,
+        watch_config.get('subscriptions'),
+        int(watch_config.get('interval', watch.INTERVAL)))
+    watches.start()
+
+    if 'metrics' in config:
+        metrics_config = config['metrics'] or {}
+        metrics.Gauge('matrix_send_queue_depth',
+                      'Messages waiting in the outbox.', outbox.depth)
+        metrics.serve(metrics_config.get('address', '127.0.0.1'),
+                      int(metrics_config.get('port', metrics.PORT)))
+
     # Add a !zabbix handler
     zabbix_handler = MRegexHandler("^!zabbix", zabbix_callback)
     bot.add_handler(zabbix_handler)
@@ -306,6 +787,7 @@ def main():
     while True:
         thread = bot.start_polling()
         thread.join()
+        metrics.SYNC_RESTARTS.inc()
         logging.warning(
             'thread died, waiting five seconds before connecting again...')
         time.sleep(5)
@@ -321,7 +803,12 @@ if __name__ == "__main__":
     else:
         set_log_level()
 
-    config = matrix.read_config(args['config'])
-    matrix_config = config['matrix']
+    if args['trace'] is True:
+        tracing.ENABLED = True
+
+    settings = bot_config.ConfigHolder(
+        args['config'],
+        on_reload=lambda snapshot: zabbix.close_sessions(
+            snapshot.realms.values()))
 
     main()
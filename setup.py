@@ -8,4 +8,5 @@ setup(
     author_email='oliviervdtoorn@gmail.com',
     packages=['matrix-zabbix-bot'],
     install_requires=['matrix-bot-api', 'matrix-client', 'pyzabbix'],
+    extras_require={'async': ['aiohttp'], 'graph': ['numpy']},
 )
@@ -0,0 +1,75 @@
+"""Author:      Olivier van der Toorn <oliviervdtoorn@gmail.com>
+Description:    Tests for the worker pool of the matrix-zabbix-bot.
+Run with `python -m unittest discover tests`.
+"""
+import os
+import sys
+import threading
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'matrix-zabbix-bot'))
+
+import dispatch  # noqa: E402
+
+TIMEOUT = 10
+
+
+class CrossRealmTest(unittest.TestCase):
+    def test_fan_out_to_other_realm_does_not_deadlock(self):
+        """Commands of realm A acking on B and commands of B acking on A
+        fill every slot before they fan out.
+        """
+        delivered = []
+        done = threading.Event()
+        commands = 4
+
+        def deliver(room, future):
+            delivered.append(future.result())
+            if len(delivered) == commands:
+                done.set()
+
+        pool = dispatch.CommandPool(deliver, workers=8, per_realm=2)
+        started = threading.Barrier(commands, timeout=TIMEOUT)
+
+        def command(other):
+            started.wait()
+            return pool.fan_out(lambda realm: realm, [(other,)])
+
+        for number, (realm, other) in enumerate(
+                [('A', 'B'), ('A', 'B'), ('B', 'A'), ('B', 'A')]):
+            room = types.SimpleNamespace(room_id='!room{0}'.format(number))
+            pool.submit(room, realm, command, other)
+
+        self.assertTrue(done.wait(TIMEOUT), 'the pool deadlocked')
+        self.assertEqual(sorted(result for [(result, _)] in delivered),
+                         ['A', 'A', 'B', 'B'])
+
+        # The slots were all given back.
+        later = threading.Event()
+        pool.deliver = lambda room, future: later.set()
+        pool.submit(types.SimpleNamespace(room_id='!later'), 'A',
+                    lambda: None)
+        self.assertTrue(later.wait(TIMEOUT))
+        self.assertEqual(pool.running['A'], 0)
+        self.assertEqual(pool.running['B'], 0)
+
+    def test_fan_out_within_held_realm(self):
+        done = threading.Event()
+        results = []
+
+        def deliver(room, future):
+            results.append(future.result())
+            done.set()
+
+        pool = dispatch.CommandPool(deliver, per_realm=1)
+        pool.submit(types.SimpleNamespace(room_id='!room'), 'A',
+                    pool.fan_out, lambda realm, value: value * 2,
+                    [('A', 1), ('A', 2)])
+        self.assertTrue(done.wait(TIMEOUT))
+        self.assertEqual(results, [[(2, None), (4, None)]])
+
+
+if __name__ == '__main__':
+    unittest.main()